@@ -0,0 +1,97 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from pandas import DataFrame
+from pandas import Series
+from optimizer import maximize_sharp_ratio
+
+# price matrix and optimization settings of a worker process, they are sent once per worker
+_worker_args = {}
+
+
+def _init_worker(prices, bounds, start_value, risk_free_rate):
+    _worker_args.update(prices=prices, bounds=bounds, start_value=start_value, risk_free_rate=risk_free_rate)
+
+
+def _optimize_window(window):
+    """
+    :param window: (start, stop) rows of the price matrix
+    :return: array of allocations
+    """
+    start, stop = window
+    return maximize_sharp_ratio(_worker_args['prices'][start:stop],
+                                _worker_args['bounds'],
+                                _worker_args['start_value'],
+                                _worker_args['risk_free_rate'])
+
+
+class Backtest:
+    """
+        Walk-forward backtest. Allocations are re-optimized every `step` rows on trailing `window` rows
+        and held out-of-sample until the next rebalancing. The price panel of the portfolio is loaded once,
+        windows are views of it, independent optimizations run in a process pool
+    """
+    def __init__(self, portfolio, window=252, step=21, workers=None):
+        """
+        :param portfolio: Portfolio with normed prices
+        :param window: number of rows used for optimization
+        :param step: number of rows between rebalancing
+        :param workers: number of processes, default is number of CPUs
+        """
+        self.portfolio = portfolio
+        self.window = window
+        self.step = step
+        self.workers = workers
+        self.logger = portfolio.logger
+
+    def _get_windows(self, n):
+        return [(stop - self.window, stop) for stop in range(self.window, n, self.step)]
+
+    def _optimize_all(self, prices, windows):
+        bounds = self.portfolio._get_bounds()
+        initargs = (prices, bounds, self.portfolio.config['start_value'], self.portfolio.config['risk_free_rate'])
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 initializer=_init_worker,
+                                 initargs=initargs) as executor:
+            return list(executor.map(_optimize_window, windows))
+
+    def run(self):
+        """
+        :return: (DataFrame of allocations indexed by rebalancing dates,
+                  Series of out-of-sample portfolio values,
+                  out-of-sample statistics (cum_ret, avg_daily_ret, std_daily_ret, sharp_ratio))
+        """
+        self.portfolio._check_prices()
+        prices = np.ascontiguousarray(self.portfolio.prices.values, dtype=np.float64)
+        dates = self.portfolio.prices.index
+        windows = self._get_windows(prices.shape[0])
+        if not windows:
+            raise ValueError("Backtest needs more than %d rows, got %d" % (self.window, prices.shape[0]))
+        self.logger.info("[%u] Backtest of '%s': %d windows of %d rows" %
+                         (os.getpid(), self.portfolio.config['name'], len(windows), self.window))
+
+        allocs = self._optimize_all(prices, windows)
+        equity = self._equity_curve(prices, windows, allocs)
+
+        allocations = DataFrame(allocs,
+                                index=dates[[stop - 1 for _, stop in windows]],
+                                columns=self.portfolio.prices.columns)
+        equity = Series(equity, index=dates[self.window - 1:])
+        stats = self.portfolio.get_portfolio_statistics(equity)
+        return allocations, equity, stats
+
+    def _equity_curve(self, prices, windows, allocs):
+        """
+            Value of the portfolio rebalanced at close of the last row of every window
+        :return: array of portfolio values since the last row of the first window
+        """
+        capital = self.portfolio.config['start_value']
+        equity = [capital]
+        for (_, stop), alloc in zip(windows, allocs):
+            period = prices[stop - 1:stop + self.step]
+            normed = period / period[0]
+            short_offset = -2 * alloc[alloc < 0].sum()
+            values = capital * (normed @ alloc + short_offset)
+            equity.extend(values[1:])
+            capital = values[-1]
+        return np.array(equity)
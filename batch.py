@@ -0,0 +1,171 @@
+import os
+import glob
+import shutil
+import tempfile
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from pandas import DataFrame
+from prototypes import Base
+from config import Config
+from quotesio import QuotesIO
+from reader import Reader
+from panel import Panel
+from portfolio import Portfolio
+from utilites import create_folder_if_not_exists
+
+SELECTORS = ('market_id', 'market_name', 'emitent_id', 'emitent_code', 'emitent_name')
+# dfrom of Reader.read for portfolios without period
+DEFAULT_START = '2016-01-01'
+
+# price panel of a worker process, memory-mapped read only
+_shared = {}
+
+
+def _init_worker(path):
+    panel = Panel.open(path)
+    _shared['panel'] = panel.values
+    _shared['index'] = panel.index
+    _shared['columns'] = panel.columns
+
+
+def _run_portfolio(task):
+    """
+        Prepare data of one portfolio from the shared panel and optimize it
+    :param task: dict made by Batch._make_task
+    :return: dict of statistics and allocations
+    """
+    index = _shared['index']
+    rows = index.slice_indexer(task['start'], task['end'])
+    positions = task['positions']
+    df = DataFrame(_shared['panel'][rows, positions],
+                   index=index[rows],
+                   columns=[_shared['columns'][pos] for pos in positions])
+    if task['reference'] in df.columns:
+        df = df.dropna(subset=[task['reference']]).rename(columns={task['reference']: task['reference'] + '_Ref'})
+    else:
+        df = df.dropna()
+    if task['normed']:
+        df = Reader._normalize_data(df)
+    if task['daily_returns']:
+        df = Reader._compute_daily_returns(df)
+    df = Reader._fill_missing_values(df)
+
+    portfolio = Portfolio(task['name'], optimize=True, data=df)
+    cum_ret, avg_daily_ret, std_daily_ret, sharp_ratio = portfolio.statistics
+    result = {'portfolio': task['name'],
+              'sharp_ratio': sharp_ratio,
+              'std_daily_ret': std_daily_ret,
+              'avg_daily_ret': avg_daily_ret,
+              'cum_ret': cum_ret}
+    result.update(zip(portfolio.prices.columns, portfolio.allocs))
+    return result
+
+
+class Batch(Base):
+    """
+        Optimize all portfolios of config/portfolios/ at once.
+        Prices of the union of their securities are read once per price field,
+        worker processes map the panel file into memory and optimize portfolios in parallel
+    """
+    def __init__(self):
+        # not __name__, the module is also run as a script
+        Base.__init__(self, 'batch')
+        self.portfolios = self._discover()
+
+    def _discover(self):
+        """
+        :return: dict {portfolio name: config}
+        """
+        portfolios = {}
+        for fname in sorted(glob.glob(os.path.join(self.config['portfolios_dir'], '*.yaml'))):
+            name = os.path.splitext(os.path.basename(fname))[0]
+            portfolios[name] = Config(path=fname).load()
+        self.logger.info("[%u] Found %d portfolios" % (os.getpid(), len(portfolios)))
+        return portfolios
+
+    @staticmethod
+    def _get_selectors(configs):
+        """
+        :return: dict {selector: list of values} of all configs
+        """
+        selectors = {selector: [] for selector in SELECTORS}
+        for config in configs:
+            for selector in SELECTORS:
+                for value in config['securities'].get(selector, {}):
+                    if value not in selectors[selector]:
+                        selectors[selector].append(value)
+        return selectors
+
+    def run(self):
+        """
+        :return: DataFrame of statistics and allocations of all portfolios
+        """
+        groups = {}
+        for name, config in self.portfolios.items():
+            groups.setdefault((config['price'], config['volume']), []).append(name)
+
+        results = []
+        for (price, volume), names in groups.items():
+            results.extend(self._run_group(names, price, volume))
+
+        table = DataFrame(results).set_index('portfolio')
+        fname = os.path.join(create_folder_if_not_exists(self.config['results_dir']),
+                             'portfolios_' + datetime.today().strftime('%d-%m-%Y') + '.csv')
+        table.to_csv(fname, sep=';')
+        self.logger.info("[%u] Results of %d portfolios are saved to %s" % (os.getpid(), table.shape[0], fname))
+        return table
+
+    def _run_group(self, names, price, volume):
+        configs = [self.portfolios[name] for name in names]
+        starts = [Portfolio._get_start_date(config) or DEFAULT_START for config in configs]
+        ends = [config['end_date'] for config in configs]
+        panel = Reader(**self._get_selectors(configs)).read(
+            reference=None,
+            dfrom=min(starts),
+            dto=None if None in ends else max(ends),
+            price=price,
+            volume=volume,
+            download_if_not_exists=any(config['download_if_not_exists'] for config in configs),
+            normed=False,
+            daily_returns=False,
+            fill_missing=False)
+
+        # pages of the file are shared by workers through the page cache
+        directory = tempfile.mkdtemp(prefix='batch_')
+        try:
+            path = os.path.join(directory, 'panel')
+            Panel.from_frame(panel, path=path, dtype='float64')
+            tasks = [self._make_task(name, config, start, end, panel.columns, volume)
+                     for name, config, start, end in zip(names, configs, starts, ends)]
+            del panel
+            with ProcessPoolExecutor(max_workers=self.config['workers'],
+                                     initializer=_init_worker,
+                                     initargs=(path,)) as executor:
+                return list(executor.map(_run_portfolio, tasks))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    @staticmethod
+    def _make_task(name, config, start, end, columns, volume):
+        """
+            Find columns of the portfolio in the union panel
+        """
+        quotes = QuotesIO(**{selector: list(config['securities'].get(selector, {})) for selector in SELECTORS})
+        securities = [sec for _, sec in quotes._find_securities()]
+        reference_field_name, reference_value = Reader._get_reference(config['reference'])
+        reference = [sec['emitent_code'] for sec in securities if sec[reference_field_name] == reference_value]
+        codes = [sec['emitent_code'] for sec in securities]
+        if volume:
+            codes += [code + '_V' for code in codes]
+        positions = sorted(columns.get_loc(code) for code in codes if code in columns)
+        return {'name': name,
+                'positions': positions,
+                'reference': reference[0] if reference else None,
+                'start': start,
+                'end': end,
+                'normed': config['normed'],
+                'daily_returns': config['daily_returns']}
+
+
+if __name__ == '__main__':
+    print(Batch().run())
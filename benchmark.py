@@ -0,0 +1,384 @@
+"""
+    Benchmark of load -> download -> read -> optimize pipeline on synthetic Finam data.
+
+    Metadata (icharts.js) and quotes are generated and served by a local stub HTTP server,
+    every stage runs in a temporary working directory with configs pointed at the stub.
+    Each repetition of a stage is run in a fresh process, so peak RSS belongs to the stage only.
+
+    python benchmark.py --securities 20 --years 5 --timeframe D
+    python benchmark.py --compare results/benchmark_old.json results/benchmark_new.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+import pandas as pd
+import yaml
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+STAGES = ('loader', 'writer', 'reader', 'optimize')
+TIMEFRAMES = ('D', '1min', '5min', '10min', '15min', '30min', 'H')
+MARKET_ID = 1
+MARKET_NAME = 'Bench'
+PORTFOLIO = 'bench'
+PRICES_FNAME = 'bench_prices.pkl'
+
+
+def make_icharts(listed):
+    """
+        Payload like https://www.finam.ru/cache/.../icharts/icharts.js
+    :param listed: number of securities in metadata
+    :return: bytes
+    """
+    ids = range(1, listed + 1)
+    lines = ['var aEmitentIds = [%s];' % ','.join(str(id_) for id_ in ids),
+             "var aEmitentNames = [%s];" % ','.join("'Emitent %d'" % id_ for id_ in ids),
+             "var aEmitentCodes = [%s];" % ','.join("'%s'" % make_code(id_) for id_ in ids),
+             'var aEmitentMarkets = [%s];' % ','.join([str(MARKET_ID)] * listed)]
+    return ('\n'.join(lines) + '\n').encode('cp1251')
+
+
+def make_market_page():
+    return ("<html>Finam.IssuerProfile.Main.setMarkets([{value: %d, title: '%s'}]);</html>" %
+            (MARKET_ID, MARKET_NAME)).encode('cp1251')
+
+
+def make_code(emitent_id):
+    return 'BENCH%d' % emitent_id
+
+
+def make_quotes(emitent_id, years, timeframe):
+    """
+        Random walk quotes in Finam export format: header 1, yyyymmdd, hhmmss, ';' separator
+    :return: (bytes of csv, number of rows)
+    """
+    days = pd.bdate_range(end=datetime.today().date(), periods=252 * years)
+    if timeframe == 'D':
+        index = days
+    else:
+        step = pd.Timedelta(pd.tseries.frequencies.to_offset(timeframe))
+        times = pd.timedelta_range(start='10:00:00', end='18:45:00', freq=step)
+        index = pd.DatetimeIndex((days.values[:, None] + times.values[None, :]).ravel())
+    rng = np.random.RandomState(emitent_id)
+    close = 100 * np.exp(np.cumsum(rng.normal(0.0002, 0.01, len(index)) / np.sqrt(len(index) / len(days))))
+    spread = np.abs(rng.normal(0, 0.002, len(index))) * close
+    df = pd.DataFrame({'<TICKER>': make_code(emitent_id),
+                       '<PER>': timeframe,
+                       '<DATE>': index.strftime('%Y%m%d'),
+                       '<TIME>': index.strftime('%H%M%S'),
+                       '<OPEN>': close,
+                       '<HIGH>': close + spread,
+                       '<LOW>': close - spread,
+                       '<CLOSE>': close,
+                       '<VOL>': rng.randint(1, 10000, len(index))})
+    return df.to_csv(sep=';', index=False, float_format='%.4f').encode(), len(df)
+
+
+class StubServer:
+    """
+        Local HTTP server of market page, icharts.js and quote exports, quotes are generated once per security
+    """
+    def __init__(self, listed, years, timeframe):
+        self.payloads = {'/market.html': make_market_page(), '/icharts.js': make_icharts(listed)}
+        self.years = years
+        self.timeframe = timeframe
+        self.quotes = {}
+        self.rows = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def get_quotes(self, emitent_id):
+        with self._lock:
+            if emitent_id not in self.quotes:
+                self.quotes[emitent_id], self.rows[emitent_id] = make_quotes(emitent_id, self.years, self.timeframe)
+            return self.quotes[emitent_id]
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/payload.csv':
+                    body = stub.get_quotes(int(parse_qs(url.query)['em'][0]))
+                    content_type = 'text/csv'
+                elif url.path in stub.payloads:
+                    body = stub.payloads[url.path]
+                    content_type = 'application/javascript'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def prepare_workspace(workdir, url, args):
+    """
+        Copy configs to working directory and point them at the stub server
+    """
+    os.makedirs(os.path.join(workdir, 'config', 'portfolios'))
+    os.makedirs(os.path.join(workdir, 'logs'))
+    shutil.copy(os.path.join(REPO_DIR, 'config', 'logging.yaml'), os.path.join(workdir, 'config'))
+
+    loader = _load_yaml(os.path.join(REPO_DIR, 'config', 'loader.yaml'))
+    loader['url'] = {'market_info': url + '/market.html', 'finam_cache': url + '/icharts.js'}
+    _dump_yaml(loader, os.path.join(workdir, 'config', 'loader.yaml'))
+
+    quotesio = _load_yaml(os.path.join(REPO_DIR, 'config', 'quotesio.yaml'))
+    quotesio['url']['export'] = url + '/'
+    quotesio['request']['period'] = args.timeframe
+    quotesio['download']['rate_limit'] = {}
+    quotesio['download']['incremental'] = False
+    if args.workers:
+        quotesio['download']['workers'] = args.workers
+        quotesio['read']['workers'] = args.workers
+    # every read is measured, not a cache hit
+    quotesio['cache']['enabled'] = False
+    _dump_yaml(quotesio, os.path.join(workdir, 'config', 'quotesio.yaml'))
+
+    codes = [make_code(id_) for id_ in range(1, args.securities + 1)]
+    portfolio = {'name': PORTFOLIO,
+                 'securities': {'emitent_code': {code: {'short': False} for code in codes}},
+                 'reference': {'emitent_code': codes[0]},
+                 'start_value': 1000000,
+                 'risk_free_rate': 0.05,
+                 'price': 'CLOSE',
+                 'volume': False,
+                 'download_if_not_exists': False,
+                 'normed': True,
+                 'daily_returns': False,
+                 'end_date': None,
+                 'period': '%d days' % (365 * args.years)}
+    _dump_yaml(portfolio, os.path.join(workdir, 'config', 'portfolios', PORTFOLIO + '.yaml'))
+    return codes
+
+
+def _load_yaml(fname):
+    with open(fname, 'r', encoding='utf8') as f:
+        return yaml.safe_load(f)
+
+
+def _dump_yaml(data, fname):
+    with open(fname, 'w', encoding='utf8') as f:
+        yaml.safe_dump(data, f, allow_unicode=True, default_flow_style=False)
+
+
+def _peak_rss():
+    """
+    :return: peak resident set size of the current process in bytes or None
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_stage(stage, workdir, codes, years, quiet=True):
+    """
+        Run one repetition of a stage, it is called in a fresh process.
+        Modules of the project resolve paths against the current directory at import, so they are imported here
+    :return: (seconds, peak RSS in bytes)
+    """
+    os.chdir(workdir)
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+
+    if stage == 'loader':
+        shutil.rmtree('metadata', ignore_errors=True)
+        from loader import Loader
+        start = time.perf_counter()
+        Loader()
+        seconds = time.perf_counter() - start
+
+    elif stage == 'writer':
+        shutil.rmtree('quotes', ignore_errors=True)
+        from writer import Writer
+        start = time.perf_counter()
+        summary = Writer('update', emitent_code=codes).save()
+        seconds = time.perf_counter() - start
+        failed = [code for code, error in summary.values() if error is not None]
+        assert not failed, "Downloads failed: %s" % failed
+
+    elif stage == 'reader':
+        from reader import Reader
+        dfrom = (pd.Timestamp.today() - pd.Timedelta(days=365 * years)).strftime('%Y-%m-%d')
+        start = time.perf_counter()
+        df = Reader('update', emitent_code=codes).read(reference={'emitent_code': codes[0]},
+                                                       dfrom=dfrom,
+                                                       download_if_not_exists=False,
+                                                       daily_returns=False)
+        seconds = time.perf_counter() - start
+        df.to_pickle(PRICES_FNAME)
+
+    elif stage == 'optimize':
+        from portfolio import Portfolio
+        import optimizer
+        # scipy is imported on the first use, it isn't a part of optimization
+        optimizer.spo.minimize
+        portfolio = Portfolio(PORTFOLIO, optimize=False, data=pd.read_pickle(PRICES_FNAME))
+        start = time.perf_counter()
+        portfolio._optimize()
+        seconds = time.perf_counter() - start
+
+    else:
+        raise ValueError("Unknown stage %s" % stage)
+    return seconds, _peak_rss()
+
+
+def summarize(runs, peaks, items, unit):
+    """
+    :param runs: list of seconds
+    :param peaks: list of peak RSS in bytes
+    :param items: amount of work of one repetition
+    :param unit: name of work unit
+    :return: dict
+    """
+    runs = np.array(runs)
+    p50, p90, p99 = np.percentile(runs, [50, 90, 99])
+    peaks = [peak for peak in peaks if peak is not None]
+    return {'runs': runs.tolist(),
+            'mean': runs.mean(),
+            'min': runs.min(),
+            'p50': p50,
+            'p90': p90,
+            'p99': p99,
+            'items': items,
+            'unit': unit,
+            'throughput': items / p50 if p50 > 0 else None,
+            'peak_rss_mb': max(peaks) / 2 ** 20 if peaks else None}
+
+
+def run(args):
+    stub = StubServer(args.listed, args.years, args.timeframe)
+    stub.start()
+    workdir = tempfile.mkdtemp(prefix='pyfolio_bench_')
+    try:
+        codes = prepare_workspace(workdir, stub.url, args)
+        # quotes are generated before measuring, so the stub doesn't slow down downloads
+        for id_ in range(1, args.securities + 1):
+            stub.get_quotes(id_)
+        work = {'loader': (args.listed, 'securities'),
+                'writer': (sum(len(stub.quotes[id_]) for id_ in stub.quotes) / 2 ** 20, 'MB'),
+                'reader': (sum(stub.rows.values()), 'quotes'),
+                'optimize': (args.securities - 1, 'securities')}
+
+        result = {'created': datetime.now().isoformat(),
+                  'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'params': vars(args).copy(),
+                  'stages': {}}
+        context = multiprocessing.get_context('spawn')
+        for stage in STAGES:
+            if stage not in args.stages:
+                continue
+            runs, peaks = [], []
+            for _ in range(args.repeat):
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    seconds, peak = executor.submit(run_stage, stage, workdir, codes, args.years,
+                                                    not args.verbose).result()
+                runs.append(seconds)
+                peaks.append(peak)
+            result['stages'][stage] = summarize(runs, peaks, *work[stage])
+            print_stage(stage, result['stages'][stage])
+    finally:
+        stub.stop()
+        if args.keep:
+            print('Working directory is kept:', workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def print_stage(stage, stats):
+    print('%-9s p50 %8.3fs  p90 %8.3fs  p99 %8.3fs  %12.1f %s/s  peak RSS %s MB' %
+          (stage, stats['p50'], stats['p90'], stats['p99'], stats['throughput'] or 0, stats['unit'],
+           '%.1f' % stats['peak_rss_mb'] if stats['peak_rss_mb'] is not None else '-'))
+
+
+def compare(old_fname, new_fname):
+    """
+        Print p50 latency and peak RSS of two saved runs side by side
+    """
+    with open(old_fname, 'r') as f:
+        old = json.load(f)
+    with open(new_fname, 'r') as f:
+        new = json.load(f)
+    if old['params'] != new['params']:
+        print('Warning: runs have different parameters')
+    print('%-9s %10s %10s %8s %10s %10s' % ('stage', 'old p50', 'new p50', 'ratio', 'old RSS', 'new RSS'))
+    for stage in STAGES:
+        if stage in old['stages'] and stage in new['stages']:
+            a, b = old['stages'][stage], new['stages'][stage]
+            print('%-9s %9.3fs %9.3fs %7.2fx %10s %10s' %
+                  (stage, a['p50'], b['p50'], b['p50'] / a['p50'] if a['p50'] else float('nan'),
+                   a['peak_rss_mb'] and '%.1f' % a['peak_rss_mb'], b['peak_rss_mb'] and '%.1f' % b['peak_rss_mb']))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of Loader, Writer, Reader and optimizer')
+    parser.add_argument('--listed', type=int, default=10000, help='securities in icharts.js')
+    parser.add_argument('--securities', type=int, default=20, help='securities downloaded, read and optimized')
+    parser.add_argument('--years', type=int, default=5, help='years of quotes')
+    parser.add_argument('--timeframe', default='D', choices=TIMEFRAMES)
+    parser.add_argument('--repeat', type=int, default=5, help='repetitions of every stage')
+    parser.add_argument('--workers', type=int, help='download and read workers, config value by default')
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES)
+    parser.add_argument('--output', help='json file, results/benchmark_<date>.json by default')
+    parser.add_argument('--keep', action='store_true', help="don't remove the working directory")
+    parser.add_argument('--verbose', action='store_true', help="don't suppress output of stages")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two saved runs and exit')
+    args = parser.parse_args(argv)
+    if args.securities < 2 or args.securities > args.listed:
+        parser.error('--securities has to be between 2 and --listed')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+    result = run(args)
+    fname = args.output
+    if fname is None:
+        os.makedirs('results', exist_ok=True)
+        fname = os.path.join('results', 'benchmark_%s.json' % datetime.now().strftime('%d-%m-%Y_%H-%M-%S'))
+    with open(fname, 'w') as f:
+        json.dump(result, f, indent=2)
+    print('Results are saved to', fname)
@@ -1,21 +1,34 @@
+import copy
 import yaml
 import log
 import os
+import threading
 
 
 class Config:
+    # parsed files shared by the process {path: (mtime, config)}
+    _cache = {}
+    _lock = threading.Lock()
+
     def __init__(self, path="config/config.yaml"):
         self.path = path
         log.setup()
         self.logger = log.logging.getLogger(__name__)
 
     def load(self):
-        """Load config file
+        """Load config file, it is parsed again only if it has been modified
         :return: dict {'parameter_name': value}
         """
         try:
-            with open(self.path, 'r') as ymlfile:
-                cfg = yaml.load(ymlfile)
+            key = os.path.abspath(self.path)
+            mtime = os.path.getmtime(key)
+            with Config._lock:
+                cached = Config._cache.get(key)
+                if cached is None or cached[0] != mtime:
+                    with open(self.path, 'r') as ymlfile:
+                        cached = (mtime, yaml.safe_load(ymlfile))
+                    Config._cache[key] = cached
+            cfg = copy.deepcopy(cached[1])
         except FileNotFoundError:
             self.logger.warning("[%u] Config file %s hasn't been found" %
                                 (os.getpid(), self.path))
@@ -0,0 +1,241 @@
+import numpy as np
+import metrics
+from meanvar import MeanVariance
+
+
+class Constraints:
+    """
+        Constraints of an allocation vector beyond bounds and |x|.sum() == 1:
+        max position |x_i| <= max_position, caps of groups sum(|x_i| of the group) <= cap,
+        turnover sum(|x - previous|) <= turnover. Transaction cost is charged per unit of turnover,
+        it is spread over holding_period samples and subtracted from mean return of a sample
+    """
+    def __init__(self, bounds, max_position=None, groups=(), previous=None, turnover=None, transaction_cost=0.0,
+                 holding_period=21):
+        """
+        :param bounds: list of (min, max) for every security
+        :param max_position: limit of |x_i|
+        :param groups: list of (name, bool array N of members, cap)
+        :param previous: array N of previous allocations, zeros by default
+        :param turnover: limit of sum(|x - previous|)
+        :param transaction_cost: cost of one unit of turnover as a share of portfolio value
+        :param holding_period: number of samples until the next rebalancing
+        """
+        lower = np.array([bound[0] for bound in bounds], dtype=np.float64)
+        upper = np.array([bound[1] for bound in bounds], dtype=np.float64)
+        if max_position is not None:
+            lower, upper = np.maximum(lower, -max_position), np.minimum(upper, max_position)
+        assert np.all(lower <= upper), "Bounds are inconsistent with max position"
+        self.lower = lower
+        self.upper = upper
+        self.groups = list(groups)
+        self.previous = np.zeros(len(bounds)) if previous is None else np.asarray(previous, dtype=np.float64)
+        self.turnover = turnover
+        self.transaction_cost = transaction_cost
+        self.holding_period = holding_period
+
+    @property
+    def period_cost(self):
+        """
+        :return: transaction cost of a unit of turnover per sample
+        """
+        return self.transaction_cost / self.holding_period
+
+    @property
+    def bounds(self):
+        return list(zip(self.lower, self.upper))
+
+    def violations(self, allocs, tol=1e-4):
+        """
+        :param allocs: array of allocations
+        :param tol: allowed residual of a constraint
+        :return: list of messages about violated constraints, empty if allocations are feasible
+        """
+        res = []
+        gross = np.abs(allocs).sum()
+        if abs(gross - 1) > tol:
+            res.append("sum(|x|) is %.4f instead of 1" % gross)
+        outside = np.flatnonzero((allocs < self.lower - tol) | (allocs > self.upper + tol))
+        if len(outside):
+            res.append("positions %s are out of bounds" % list(outside))
+        for name, members, cap in self.groups:
+            exposure = np.abs(allocs[members]).sum()
+            if exposure > cap + tol:
+                res.append("group %s has %.4f over cap %s" % (name, exposure, cap))
+        if self.turnover is not None:
+            turnover = np.abs(allocs - self.previous).sum()
+            if turnover > self.turnover + tol:
+                res.append("turnover %.4f is over limit %s" % (turnover, self.turnover))
+        return res
+
+    @classmethod
+    def from_config(cls, config, bounds, columns, securities):
+        """
+            Constraints from 'constraints' section of portfolio config like
+            {max_position: 0.4, groups: {market_name: {shares: 0.6}, market_id: {1: 0.3}},
+             previous: {SBER: 0.5, GAZP: -0.5}, turnover: 0.5, transaction_cost: 0.001, holding_period: 21}
+        :param config: 'constraints' section
+        :param bounds: list of (min, max) for every column
+        :param columns: names of price columns
+        :param securities: dict {column: metadata record} to find markets of columns
+        :return: Constraints
+        """
+        groups = []
+        for field, caps in (config.get('groups') or {}).items():
+            assert field in ('market_id', 'market_name'), "Securities can be grouped by market_id or market_name"
+            for value, cap in caps.items():
+                members = np.array([col in securities and str(securities[col][field]) == str(value)
+                                    for col in columns])
+                groups.append(('%s=%s' % (field, value), members, cap))
+        previous = config.get('previous')
+        if previous is not None:
+            previous = [previous.get(col, 0.0) for col in columns]
+        return cls(bounds,
+                   max_position=config.get('max_position'),
+                   groups=groups,
+                   previous=previous,
+                   turnover=config.get('turnover'),
+                   transaction_cost=config.get('transaction_cost', 0.0),
+                   holding_period=config.get('holding_period', 21))
+
+
+class ConstrainedOptimizer:
+    """
+        Max Sharp ratio of a mean-variance model under Constraints.
+        With cvxpy it is solved as a convex QP: allocations are scaled by kappa > 0 so that net excess return
+        is 1 and variance is minimized (Sharp ratio doesn't depend on scale), |y| is bounded by t and
+        sum(t) == kappa. If the sign of every position is fixed by bounds, t == |y| and the QP is exact.
+        Otherwise sum(|x|) can be less than 1, then signs are fixed by the relaxed solution and the QP is solved again.
+        Without cvxpy, if the QP fails (e.g. no allocation has positive excess return) or its solution
+        still violates constraints, SLSQP is used starting from the QP solution
+    """
+    def __init__(self, model: MeanVariance, constraints: Constraints):
+        self.model = model
+        self.constraints = constraints
+        # solver used by the last solve, messages about its failure and violated constraints
+        # and the reason of falling back to SLSQP
+        self.solver = None
+        self.errors = []
+        self.qp_error = None
+
+    def solve(self, solver='auto', strict=False):
+        """
+            Allocations of max Sharp ratio, self.errors lists violated constraints
+            if the solution isn't feasible
+        :param solver: 'auto' (cvxpy if it is installed), 'cvxpy' or 'slsqp'
+        :param strict: raise ValueError instead of returning infeasible allocations
+        :return: array of allocations
+        """
+        allocs = self._solve(solver)
+        self.errors.extend(self.constraints.violations(allocs))
+        if self.errors and self.qp_error:
+            self.errors.insert(0, self.qp_error)
+        if strict and self.errors:
+            raise ValueError("Constraints can't be satisfied: %s" % '; '.join(self.errors))
+        return allocs
+
+    def _solve(self, solver):
+        self.errors = []
+        self.qp_error = None
+        assert solver in ('auto', 'cvxpy', 'slsqp'), "Unknown solver %s" % solver
+        x0 = None
+        if solver != 'slsqp':
+            try:
+                import cvxpy
+            except ImportError:
+                if solver == 'cvxpy':
+                    raise
+            else:
+                self.solver = 'cvxpy'
+                c = self.constraints
+                signs = np.where(c.lower >= 0, 1, np.where(c.upper <= 0, -1, 0))
+                allocs = self._solve_qp(cvxpy, signs)
+                if allocs is not None and np.any(signs == 0) and c.violations(allocs):
+                    # positions of both signs are possible, the relaxation isn't tight,
+                    # signs of the relaxed solution make the problem convex and exact
+                    excess = np.sign(self.model.mean - self.model.period_risk_free_rate)
+                    signs = np.where(signs != 0, signs,
+                                     np.where(np.abs(allocs) > 1e-9, np.sign(allocs), np.where(excess < 0, -1, 1)))
+                    allocs = self._solve_qp(cvxpy, signs) if np.all(signs != 0) else allocs
+                if allocs is not None and not c.violations(allocs):
+                    return allocs
+                if allocs is not None:
+                    self.qp_error = "QP solution violates constraints: %s" % '; '.join(c.violations(allocs))
+                    x0 = allocs / max(np.abs(allocs).sum(), 1e-12)
+        self.solver = 'slsqp'
+        return self._solve_slsqp(x0)
+
+    def _solve_qp(self, cvxpy, signs):
+        """
+        :param signs: array N, 1 for long-only, -1 for short-only and 0 for positions of any sign
+        :return: array of allocations or None if the problem isn't solved
+        """
+        c = self.constraints
+        n = len(self.model.mean)
+        scale = self.model._return_scale
+        y, t, kappa = cvxpy.Variable(n), cvxpy.Variable(n, nonneg=True), cvxpy.Variable()
+        cons = [cvxpy.sum(t) == kappa,
+                kappa >= 0,
+                y >= c.lower * kappa,
+                y <= c.upper * kappa]
+        fixed, free = np.flatnonzero(signs != 0), np.flatnonzero(signs == 0)
+        if len(fixed):
+            cons.append(t[fixed] == cvxpy.multiply(signs[fixed].astype(np.float64), y[fixed]))
+        if len(free):
+            cons += [t[free] >= y[free], t[free] >= -y[free]]
+        cons += [members.astype(np.float64) @ t <= cap * kappa for _, members, cap in c.groups]
+        trade = cvxpy.norm1(y - c.previous * kappa)
+        if c.turnover is not None:
+            cons.append(trade <= c.turnover * kappa)
+        # risk free rate is charged once for |x|.sum() == 1 as in MeanVariance
+        excess = self.model.mean @ y - self.model.period_risk_free_rate * kappa - c.period_cost * trade
+        cons.append(scale * excess >= 1)
+        cov = self.model.cov * self.model._variance_scale
+        problem = cvxpy.Problem(cvxpy.Minimize(cvxpy.quad_form(y, cvxpy.psd_wrap(cov))), cons)
+        try:
+            problem.solve()
+        except cvxpy.error.SolverError as e:
+            self.qp_error = "QP failed: %s" % e
+            return None
+        finally:
+            metrics.count('optimizer_runs_total', method='cvxpy')
+        if problem.status not in ('optimal', 'optimal_inaccurate') or not kappa.value or kappa.value <= 0:
+            self.qp_error = "QP is %s" % problem.status
+            return None
+        return y.value / kappa.value
+
+    def _neg_sharp_ratio(self, allocs):
+        """
+            Negative annualized Sharp ratio net of transaction costs and its gradient
+        """
+        model, c = self.model, self.constraints
+        cov_x = model.cov @ allocs
+        vol = np.sqrt(allocs @ cov_x)
+        trade = allocs - c.previous
+        excess = allocs @ model.mean - model.period_risk_free_rate - c.period_cost * np.abs(trade).sum()
+        d_excess = model.mean - c.period_cost * np.sign(trade)
+        value = -excess / vol * model.k
+        grad = -model.k * (d_excess * vol - excess * cov_x / vol) / vol ** 2
+        return value, grad
+
+    def _solve_slsqp(self, x0=None):
+        """
+        :param x0: initial guess, previous allocations or MeanVariance initial guess by default
+        :return: array of allocations
+        """
+        c = self.constraints
+        cons = [{'type': 'ineq',
+                 'fun': lambda x, members=members, cap=cap: cap - np.abs(x[members]).sum(),
+                 'jac': lambda x, members=members: -np.sign(x) * members}
+                for _, members, cap in c.groups]
+        if c.turnover is not None:
+            cons.append({'type': 'ineq',
+                         'fun': lambda x: c.turnover - np.abs(x - c.previous).sum(),
+                         'jac': lambda x: -np.sign(x - c.previous)})
+        if x0 is None:
+            x0 = np.clip(c.previous, c.lower, c.upper) if np.abs(c.previous).sum() \
+                else self.model._initial_guess(c.bounds)
+        result = self.model._minimize(self._neg_sharp_ratio, x0, c.bounds, cons)
+        if not result.success:
+            self.errors.append("SLSQP failed: %s" % result.message)
+        return result.x
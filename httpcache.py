@@ -0,0 +1,87 @@
+import os
+import json
+import hashlib
+from utilites import lazy_import
+from urllib.parse import urlparse
+import metrics
+
+requests = lazy_import('requests')
+
+
+class HttpCache:
+    """
+        Local cache of HTTP responses.
+        Stored responses are revalidated with If-None-Match/If-Modified-Since,
+        body is streamed to disk and its sha256 is kept to detect unchanged content
+        when the server doesn't support conditional requests
+    """
+    def __init__(self, directory, chunk_size=65536):
+        self.directory = directory
+        self.chunk_size = chunk_size
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode()).hexdigest()
+        return os.path.join(self.directory, key + '.body'), os.path.join(self.directory, key + '.json')
+
+    def _load_meta(self, url):
+        body_fname, meta_fname = self._paths(url)
+        if not (os.path.isfile(body_fname) and os.path.isfile(meta_fname)):
+            return None
+        with open(meta_fname, 'r') as f:
+            return json.load(f)
+
+    def get(self, url, headers=None, timeout=None):
+        """
+            Get response body through the cache
+        :param url: str
+        :param headers: dict of request headers
+        :param timeout: seconds
+        :return: dict {'fname': path to body, 'sha256': str,
+                       'encoding': charset of response or None, 'status': 200 or 304}
+        """
+        body_fname, meta_fname = self._paths(url)
+        meta = self._load_meta(url)
+        # validators go first, some servers stop parsing at a malformed header
+        conditional = {}
+        if meta is not None:
+            if meta.get('etag'):
+                conditional['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                conditional['If-Modified-Since'] = meta['last_modified']
+        headers = dict(conditional, **(headers or {}))
+
+        host = urlparse(url).hostname
+        with metrics.timer('http_request_seconds', host=host):
+            r = requests.get(url, headers=headers, stream=True, timeout=timeout)
+        metrics.count('http_requests_total', host=host, status=r.status_code)
+        with r:
+            if r.status_code == 304 and meta is not None:
+                return dict(meta, fname=body_fname, status=304)
+            assert r.status_code == 200, "Response error - %s" % r.status_code
+            sha256 = hashlib.sha256()
+            size = 0
+            tmp_fname = body_fname + '.tmp'
+            with open(tmp_fname, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    sha256.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(tmp_fname, body_fname)
+            metrics.count('http_response_bytes_total', size, host=host)
+            meta = {'url': url,
+                    'etag': r.headers.get('ETag'),
+                    'last_modified': r.headers.get('Last-Modified'),
+                    'sha256': sha256.hexdigest(),
+                    'encoding': r.encoding if 'charset' in r.headers.get('Content-Type', '').lower() else None}
+        with open(meta_fname, 'w') as f:
+            json.dump(meta, f)
+        return dict(meta, fname=body_fname, status=200)
+
+    def iter_body(self, fname):
+        """
+        :param fname: path to body returned by get
+        :return: generator of bytes chunks
+        """
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                yield chunk
@@ -0,0 +1,146 @@
+import numpy as np
+
+
+def as_float(a):
+    """
+        Contiguous float64 view of array, a copy is made only if it is needed
+    :param a: array-like
+    :return: np.ndarray
+    """
+    return np.ascontiguousarray(a, dtype=np.float64)
+
+
+def _as_2d(a):
+    return a.reshape(a.shape[0], -1)
+
+
+def first_valid(a):
+    """
+        First non-NaN value of every column, NaN for columns without values
+    :param a: 1d or 2d array
+    :return: float64 scalar for 1d array, 1d array for 2d one
+    """
+    a = np.asarray(a)
+    a2 = _as_2d(a)
+    rows = (~np.isnan(a2)).argmax(axis=0)
+    return a2[rows, np.arange(a2.shape[1])].astype(np.float64).reshape(a.shape[1:])
+
+
+def normalize(a, out=None, skipna=False):
+    """
+        Divide every column by its first value, float32 prices are divided without a float64 copy
+    :param a: 1d or 2d array of prices
+    :param out: array of the same shape for result, it can be a itself
+    :param skipna: divide by the first non-NaN value of a column instead of the first row
+    :return: out or new float64 array
+    """
+    a = np.asarray(a)
+    base = first_valid(a) if skipna else a[0].astype(np.float64)
+    if out is None:
+        return np.divide(a, base, dtype=np.float64)
+    return np.divide(a, base, out=out)
+
+
+def dot(a, x, chunk_rows=65536):
+    """
+        Matrix-vector or matrix-matrix product in float64 by blocks of rows,
+        so a float32 or memory-mapped matrix is never copied as a whole
+    :param a: 2d array T x N
+    :param x: 1d array N or 2d array N x K
+    :param chunk_rows: rows of one block
+    :return: float64 array T or T x K
+    """
+    x = as_float(x)
+    if a.dtype == np.float64:
+        return a @ x
+    res = np.empty((a.shape[0],) + x.shape[1:])
+    for start in range(0, a.shape[0], chunk_rows):
+        res[start:start + chunk_rows] = a[start:start + chunk_rows].astype(np.float64) @ x
+    return res
+
+
+def simple_returns(a, out=None, skipna=False, first=0.0):
+    """
+        Returns p[t] / p[t-1] - 1 along the first axis
+    :param a: 1d or 2d array of prices
+    :param out: array of the same shape for result, it can be a itself
+    :param skipna: return is computed against the last non-NaN price, otherwise NaN price gives NaN return
+    :param first: value of the first row
+    :return: out or new array
+    """
+    out = _returns(a, out, skipna, first)
+    out[1:] -= 1
+    return out
+
+
+def log_returns(a, out=None, skipna=False, first=0.0):
+    """
+        Returns log(p[t] / p[t-1]) along the first axis
+    :param a: 1d or 2d array of prices
+    :param out: array of the same shape for result, it can be a itself
+    :param skipna: return is computed against the last non-NaN price, otherwise NaN price gives NaN return
+    :param first: value of the first row
+    :return: out or new array
+    """
+    out = _returns(a, out, skipna, first)
+    np.log(out[1:], out=out[1:])
+    return out
+
+
+def _returns(a, out, skipna, first):
+    """
+        Ratio p[t] / p[t-1] to out[1:], out[0] = first
+    """
+    a = as_float(a)
+    if out is None:
+        out = np.empty_like(a)
+    if len(a) == 0:
+        return out
+    previous = ffill(a[:-1]) if skipna else a[:-1]
+    # numpy buffers overlapping operands, so out can be a
+    np.divide(a[1:], previous, out=out[1:])
+    out[0] = first
+    return out
+
+
+def ffill(a, out=None):
+    """
+        Propagate the last non-NaN value forward along the first axis, leading NaN are kept
+    :param a: 1d or 2d array
+    :param out: array of the same shape for result, it can be a itself
+    :return: out or new array
+    """
+    a = as_float(a)
+    a2 = _as_2d(a)
+    rows = np.arange(a2.shape[0]).reshape(-1, 1)
+    last = np.where(np.isnan(a2), 0, rows)
+    np.maximum.accumulate(last, axis=0, out=last)
+    filled = a2[last, np.arange(a2.shape[1])].reshape(a.shape)
+    if out is None:
+        return filled
+    out[...] = filled
+    return out
+
+
+def bfill(a, out=None):
+    """
+        Propagate the next non-NaN value backward along the first axis, trailing NaN are kept
+    :param a: 1d or 2d array
+    :param out: array of the same shape for result, it can be a itself
+    :return: out or new array
+    """
+    filled = ffill(as_float(a)[::-1])[::-1]
+    if out is None:
+        return np.ascontiguousarray(filled)
+    out[...] = filled
+    return out
+
+
+def fill_missing(a, out=None):
+    """
+        Forward fill and then backward fill for leading NaN
+    :param a: 1d or 2d array
+    :param out: array of the same shape for result, it can be a itself
+    :return: out or new array
+    """
+    return bfill(ffill(a), out=out)
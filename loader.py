@@ -1,44 +1,109 @@
-import requests
 import json
+import hashlib
+import shutil
 import pandas as pd
 import os
+from datetime import datetime
 from utilites import create_folder_if_not_exists
 from utilites import save_file
+from utilites import get_path
 from prototypes import Base
+from httpcache import HttpCache
+import metrics
 
 
 class Loader(Base):
+    """
+        Load metadata of available securities from Finam and save it to metadata/dd-mm-yyyy.csv.
+        Responses are cached in metadata/http_cache, if markets and emitents haven't changed
+        since the previous run, the previous metadata file is copied without parsing
+    """
     path_to_metadata = create_folder_if_not_exists()
+    http_cache_dir = 'metadata/http_cache'
+    columns = ('market_id', 'market_name', 'emitent_id', 'emitent_code', 'emitent_name')
 
     def __init__(self):
         Base.__init__(self, __name__)
+        self.http_cache = HttpCache(create_folder_if_not_exists(dirname=Loader.http_cache_dir))
+        self.metadata_fname = Loader.path_to_metadata + datetime.today().strftime('%d-%m-%Y') + '.csv'
+        self._available_data = None
+        self._load()
 
-        self._markets_name = self._get_markets(key='id')
-        self._data_from_cache = self._get_data_from_cache()
+    @metrics.staged('load')
+    def _load(self):
+        market_info_substr = self._get_market_substring()
+        cache_response = self._get_cache_response()
+        state = {'markets': hashlib.sha256(market_info_substr.encode()).hexdigest(),
+                 'emitents': cache_response['sha256']}
+        if self._is_unchanged(state):
+            return
+
+        self._markets_name = self._get_markets(key='id', market_info_substr=market_info_substr)
+        self._emitent_info = self._get_data_from_cache(cache_response)
         self.emitent_ids = self._get_emitent_ids()
         self.emitent_names = self._get_emitent_names()
         self.emitent_codes = self._get_emitent_codes()
         self.emitent_markets_ids = self._get_emitent_markets()
         self.emitent_market_names = [self._markets_name[int(id_)] for id_ in self.emitent_markets_ids]
-        self.available_data = self._make_df()
+        self._available_data = self._make_df()
+
+        save_file(payload=self._available_data, path=Loader.path_to_metadata)
+        self._save_state(state)
+
+    @property
+    def available_data(self):
+        if self._available_data is None:
+            # the same str values as parsed ones, ids and codes aren't converted to numbers
+            self._available_data = pd.read_csv(self.metadata_fname, sep=';', index_col=0,
+                                               dtype={column: str for column in Loader.columns},
+                                               keep_default_na=False)
+        return self._available_data
+
+    def _state_fname(self):
+        return os.path.join(get_path(Loader.http_cache_dir), 'state.json')
+
+    def _is_unchanged(self, state):
+        """
+            Check whether markets and emitents are the same as in the previous run,
+            in this case the previous metadata file is copied to today's one
+        :param state: dict of content hashes
+        :return: bool
+        """
+        if not os.path.isfile(self._state_fname()):
+            return False
+        with open(self._state_fname(), 'r') as f:
+            previous = json.load(f)
+        if previous['hashes'] != state or not os.path.isfile(previous['metadata']):
+            return False
+        if previous['metadata'] != self.metadata_fname:
+            shutil.copyfile(previous['metadata'], self.metadata_fname)
+        self.logger.info("[%u] Metadata hasn't changed since %s" % (os.getpid(), previous['metadata']))
+        return True
 
-        save_file(payload=self.available_data, path=Loader.path_to_metadata)
+    def _save_state(self, state):
+        with open(self._state_fname(), 'w') as f:
+            json.dump({'hashes': state, 'metadata': self.metadata_fname}, f)
 
     def _get_response(self, url):
-        r = requests.get(url, headers=self.config['headers'])
-        assert r.status_code == 200, "Response error - %s" % r.status_code
-        self.logger.debug("Response is - %s" % r.text)
-        return r.text
+        response = self.http_cache.get(url, headers=self.config['headers'])
+        with open(response['fname'], 'r', encoding=response['encoding'] or self.config['default_encoding']) as f:
+            text = f.read()
+        self.logger.debug("Response is - %s", text)
+        return text
+
+    def _get_market_substring(self):
+        market_info_raw_data = self._get_response(self.config['url']['market_info'])
+        return self._find_substring(text=market_info_raw_data,
+                                    start=self.config['str_template']['market_substring_start_from'],
+                                    stop=self.config['str_template']['market_substring_stop'])
 
-    def _get_markets(self, key):
+    def _get_markets(self, key, market_info_substr=None):
         """
             Prepare dict of available markets
         :return: dict {market: id}
         """
-        market_info_raw_data = self._get_response(self.config['url']['market_info'])
-        market_info_substr = self._find_substring(text=market_info_raw_data,
-                                                  start=self.config['str_template']['market_substring_start_from'],
-                                                  stop=self.config['str_template']['market_substring_stop'])
+        if market_info_substr is None:
+            market_info_substr = self._get_market_substring()
         markets_in_json = self._turn_str_into_valid_json(market_info_substr)
         return self._to_dict(self._to_json(markets_in_json), key=key)
 
@@ -53,14 +118,14 @@ class Loader(Base):
         start_pos = text.find(start) + len(start)
         end_pos = text[start_pos:].find(stop)
         substring = text[start_pos:][:end_pos]
-        self.logger.debug("Substring is = %s" % substring)
+        self.logger.debug("Substring is = %s", substring)
         return substring
 
     def _turn_str_into_valid_json(self, text):
         text = text.replace("value:", '"value":')\
                                                   .replace("title:", '"title":')\
                                                   .replace("'", '"')
-        self.logger.debug("Valid json string is = %s" % text)
+        self.logger.debug("Valid json string is = %s", text)
         return text
 
     def _to_json(self, text):
@@ -71,7 +136,7 @@ class Loader(Base):
         """
         # transform substring to json
         json_data = json.loads(text)
-        self.logger.debug("Transformed to JSON %s" % json_data)
+        self.logger.debug("Transformed to JSON %s", json_data)
         return json_data
 
     def _to_dict(self, json_data, key):
@@ -88,7 +153,7 @@ class Loader(Base):
         else:
             self.logger.error("Unknown value of key parameter - %s" % key)
             dictionary = {}
-        self.logger.debug("Transformed to dict %s" % dictionary)
+        self.logger.debug("Transformed to dict %s", dictionary)
         return dictionary
 
     def show(self, column):
@@ -99,9 +164,80 @@ class Loader(Base):
         """
         print(self.available_data[column].unique())
 
-    def _get_data_from_cache(self):
+    def _get_cache_response(self):
         self.logger.info("[%u] Receiving data from cache..." % os.getpid())
-        return self._get_response(self.config['url']['finam_cache'])
+        response = self.http_cache.get(self.config['url']['finam_cache'], headers=self.config['headers'])
+        self.logger.info("[%u] Cache response status is %s" % (os.getpid(), response['status']))
+        return response
+
+    def _get_data_from_cache(self, response):
+        """
+            Extract emitent lists from the stored cache in one pass
+        :param response: dict returned by HttpCache.get
+        :return: dict {type_info: bytes between start and stop templates}
+        """
+        self._cache_encoding = response['encoding'] or self.config['default_encoding']
+        return self._extract_substrings(self.http_cache.iter_body(response['fname']), self._get_templates())
+
+    def _get_templates(self):
+        """
+        :return: dict {type_info: (start, stop)} where start and stop are bytes
+        """
+        templates = {}
+        for type_info in ('emitent_ids', 'emitent_names', 'emitent_codes', 'emitent_markets'):
+            template = self.config['str_template'][type_info]
+            templates[type_info] = (template['start_from'].encode(), template['stop'].encode())
+        return templates
+
+    @staticmethod
+    def _extract_substrings(chunks, templates):
+        """
+            Extract substrings between start and stop templates in one pass over chunks of bytes.
+            Only a tail shorter than a template is carried between chunks,
+            the first occurrence of every start template is used
+        :param chunks: iterable of bytes
+        :param templates: dict {name: (start, stop)}
+        :return: dict {name: bytes}
+        """
+        pending = dict(templates)
+        found = {}
+        current = None
+        collected = bytearray()
+        start_tail = max(len(start) for start, _ in templates.values()) - 1
+        buf = b''
+        for chunk in chunks:
+            buf = buf + chunk if buf else chunk
+            pos = 0
+            while pending:
+                if current is None:
+                    first = None
+                    for name, (start, _) in pending.items():
+                        idx = buf.find(start, pos)
+                        if idx != -1 and (first is None or idx < first[0]):
+                            first = (idx, name)
+                    if first is None:
+                        pos = max(pos, len(buf) - start_tail)
+                        break
+                    current = first[1]
+                    pos = first[0] + len(pending[current][0])
+                else:
+                    stop = pending[current][1]
+                    end = buf.find(stop, pos)
+                    if end == -1:
+                        cut = max(pos, len(buf) - len(stop) + 1)
+                        collected += buf[pos:cut]
+                        pos = cut
+                        break
+                    collected += buf[pos:end]
+                    found[current] = bytes(collected)
+                    collected = bytearray()
+                    del pending[current]
+                    current = None
+                    pos = end + len(stop)
+            if not pending:
+                break
+            buf = buf[pos:]
+        return found
 
     def _get_emitent_ids(self):
         """
@@ -133,28 +269,24 @@ class Loader(Base):
         :param type_info: str what kind info will be extract
         :return: list
         """
-        text = self._data_from_cache
-        start = self.config['str_template'][type_info]['start_from']
-        stop = self.config['str_template'][type_info]['stop']
+        assert type_info in self._emitent_info, "%s hasn't been found in cache" % type_info
         split_symbol = self.config['str_template'][type_info]['split_symbol']
-        emitent_substr = self._find_substring(text=text, start=start, stop=stop)
+        emitent_substr = self._emitent_info.pop(type_info).decode(self._cache_encoding)
         emitent_list = emitent_substr.split(split_symbol)
-        self.logger.debug('[%u] %s list is %s' %
-                          (os.getpid(), type_info, emitent_list))
-        self.logger.debug('[%u] First element %s list is %s' %
-                          (os.getpid(), type_info, emitent_list[0]))
+        self.logger.debug('[%u] %s list is %s', os.getpid(), type_info, emitent_list)
+        self.logger.debug('[%u] First element %s list is %s', os.getpid(), type_info, emitent_list[0])
         return emitent_list
 
     def _make_df(self):
-        self.logger.debug("market_id list has length: %d" % len(self.emitent_markets_ids))
-        self.logger.debug("market_name list has length: %d" % len(self.emitent_market_names))
-        self.logger.debug("emitent_id list has length: %d" % len(self.emitent_ids))
-        self.logger.debug("emitent_code list has length: %d" % len(self.emitent_codes))
-        self.logger.debug("emitent_name list has length: %d" % len(self.emitent_names))
+        self.logger.debug("market_id list has length: %d", len(self.emitent_markets_ids))
+        self.logger.debug("market_name list has length: %d", len(self.emitent_market_names))
+        self.logger.debug("emitent_id list has length: %d", len(self.emitent_ids))
+        self.logger.debug("emitent_code list has length: %d", len(self.emitent_codes))
+        self.logger.debug("emitent_name list has length: %d", len(self.emitent_names))
         return pd.DataFrame({
             'market_id': self.emitent_markets_ids,
             'market_name': self.emitent_market_names,
             'emitent_id': self.emitent_ids,
             'emitent_code': self.emitent_codes,
             'emitent_name': self.emitent_names
-        })
+        }, columns=list(Loader.columns))
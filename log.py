@@ -2,21 +2,29 @@ import os
 import logging.config
 import yaml
 
+# (path, mtime) of the applied configuration
+_applied = None
+
 
 def setup(
         default_path='config/logging.yaml',
         default_level=logging.INFO,
         env_key='LOG_CFG'  # to load the logging configuration from specific path
 ):
-    """Setup logging configuration
+    """Setup logging configuration, the file is applied again only if it has been modified
     """
+    global _applied
     path = default_path
     value = os.getenv(env_key, None)
     if value:
         path = value
     if os.path.exists(path):
+        state = (os.path.abspath(path), os.path.getmtime(path))
+        if state == _applied:
+            return
         with open(path, 'rt') as f:
             config = yaml.safe_load(f.read())
         logging.config.dictConfig(config)
+        _applied = state
     else:
         logging.basicConfig(level=default_level)
@@ -1,5 +1,91 @@
-from portfolio import Portfolio
+import os
+import sys
+import glob
+import argparse
+from metaindex import MetadataIndex
+from utilites import get_path
+
+# heavy modules (pandas, scipy, requests) are imported by commands which need them
+
+
+def _metadata_fname(date=None):
+    """
+    :param date: 'dd-mm-yyyy' or None for the newest metadata file
+    :return: str
+    """
+    path = get_path('metadata')
+    if date is not None:
+        return path + date + '.csv'
+    list_of_files = glob.glob(path + '*.csv')
+    if not list_of_files:
+        sys.exit("There is no metadata in %s, run 'python main.py update'" % path)
+    return max(list_of_files, key=os.path.getctime)
+
+
+def list_securities(args):
+    index = MetadataIndex.load(_metadata_fname(args.date))
+    selectors = {'market_id': args.market_id, 'market_name': args.market_name, 'emitent_id': args.emitent_id,
+                 'emitent_code': args.emitent_code, 'emitent_name': args.emitent_name}
+    if any(selectors.values()):
+        securities = index.find(**selectors)
+    else:
+        securities = index.securities
+    for sec in securities[:args.limit]:
+        print('\t'.join(str(sec[field]) for field in ('emitent_id', 'emitent_code', 'market_id',
+                                                      'market_name', 'emitent_name')))
+
+
+def list_markets(args):
+    index = MetadataIndex.load(_metadata_fname(args.date))
+    markets = {}
+    for sec in index.securities:
+        name, number = markets.get(sec.market_id, (sec.market_name, 0))
+        markets[sec.market_id] = (name, number + 1)
+    for market_id, (name, number) in sorted(markets.items()):
+        print('%s\t%s\t%d' % (market_id, name, number))
+
+
+def update_metadata(args):
+    from loader import Loader
+    Loader()
+
+
+def optimize_portfolio(args):
+    from portfolio import Portfolio
+    Portfolio(args.name)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='pyfolio')
+    commands = parser.add_subparsers(dest='command')
+
+    securities = commands.add_parser('securities', help='list securities of metadata, all of them without filters')
+    securities.add_argument('--market-id', nargs='+', default=(), type=int)
+    securities.add_argument('--market-name', nargs='+', default=())
+    securities.add_argument('--emitent-id', nargs='+', default=())
+    securities.add_argument('--emitent-code', nargs='+', default=())
+    securities.add_argument('--emitent-name', nargs='+', default=())
+    securities.add_argument('--limit', type=int)
+    securities.add_argument('--date', help='dd-mm-yyyy of metadata file, the newest one by default')
+    securities.set_defaults(func=list_securities)
+
+    markets = commands.add_parser('markets', help='list markets and number of their securities')
+    markets.add_argument('--date', help='dd-mm-yyyy of metadata file, the newest one by default')
+    markets.set_defaults(func=list_markets)
+
+    update = commands.add_parser('update', help='load metadata from Finam')
+    update.set_defaults(func=update_metadata)
+
+    portfolio = commands.add_parser('portfolio', help='optimize portfolio of config/portfolios/<name>.yaml')
+    portfolio.add_argument('name', nargs='?', default='currencies')
+    portfolio.set_defaults(func=optimize_portfolio)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args = parser.parse_args(['portfolio'])
+    return args
 
 
 if __name__ == '__main__':
-    t = Portfolio('currencies')
+    args = parse_args()
+    args.func(args)
@@ -0,0 +1,231 @@
+import numpy as np
+from pandas import DataFrame
+from kernels import simple_returns
+import metrics
+from utilites import lazy_import
+
+spo = lazy_import('scipy.optimize')
+
+
+class MeanVariance:
+    """
+        Mean-variance model of a portfolio. Mean daily returns and covariance matrix
+        are computed once from prices, every statistic of an allocation vector is a matrix product.
+        Short position is a negative allocation of the security return,
+        allocations satisfy |x|.sum() == 1 as in Portfolio._optimize.
+        Statistics are of a portfolio rebalanced to constant weights every day
+    """
+    estimators = ('sample', 'ledoit_wolf', 'ewma')
+
+    def __init__(self, prices, risk_free_rate, samples_per_year=252, estimator='sample', ewma_decay=0.94):
+        """
+        :param prices: 2d array-like T x N of prices or normed prices
+        :param risk_free_rate: annual risk free rate
+        :param samples_per_year: daily=252, weekly=52, monthly=12
+        :param estimator: covariance estimator 'sample', 'ledoit_wolf' (shrinkage to scaled identity)
+                          or 'ewma' (exponentially weighted mean and covariance)
+        :param ewma_decay: weight of the previous day for 'ewma', RiskMetrics uses 0.94
+        """
+        assert estimator in self.estimators, "Unknown covariance estimator %s" % estimator
+        returns = simple_returns(np.asarray(prices))[1:]
+        self.estimator = estimator
+        self.shrinkage = None
+        if estimator == 'ewma':
+            self.mean, self.cov = self._ewma(returns, ewma_decay)
+        else:
+            self.mean = returns.mean(axis=0)
+            if estimator == 'ledoit_wolf':
+                self.cov, self.shrinkage = self._ledoit_wolf(returns)
+            else:
+                self.cov = np.atleast_2d(np.cov(returns, rowvar=False))
+        self.period_risk_free_rate = (risk_free_rate + 1) ** (1 / samples_per_year) - 1
+        self.k = np.sqrt(samples_per_year)
+        # daily variances and returns are too small for SLSQP tolerance, so they are rescaled
+        self._variance_scale = 1 / np.mean(np.diag(self.cov))
+        self._return_scale = 1 / np.abs(self.mean).max()
+
+    @staticmethod
+    def _ledoit_wolf(returns):
+        """
+            Ledoit-Wolf shrinkage of the sample covariance to mu * I, mu is the mean variance
+        :return: (covariance matrix, shrinkage intensity)
+        """
+        n, p = returns.shape
+        x = returns - returns.mean(axis=0)
+        cov = x.T @ x / n
+        x2 = x ** 2
+        mu = np.trace(cov) / p
+        delta = ((cov ** 2).sum() - 2 * mu * np.trace(cov) + p * mu ** 2) / p
+        beta = ((x2.T @ x2).sum() / n - (cov ** 2).sum()) / (p * n)
+        shrinkage = 0.0 if delta == 0 else min(beta, delta) / delta
+        cov = (1 - shrinkage) * cov
+        cov.flat[::p + 1] += shrinkage * mu
+        return cov, shrinkage
+
+    @staticmethod
+    def _ewma(returns, decay):
+        """
+            Exponentially weighted mean and covariance, weight of day t is decay ** (T - 1 - t)
+        :return: (mean, covariance matrix)
+        """
+        weights = decay ** np.arange(len(returns) - 1, -1, -1, dtype=np.float64)
+        weights /= weights.sum()
+        mean = weights @ returns
+        x = returns - mean
+        cov = (x * weights[:, None]).T @ x / (1 - (weights ** 2).sum())
+        return mean, np.atleast_2d(cov)
+
+    def expected_return(self, allocs):
+        return allocs @ self.mean
+
+    def volatility(self, allocs):
+        return np.sqrt(allocs @ self.cov @ allocs)
+
+    def sharp_ratio(self, allocs):
+        """
+        :return: annualized Sharp ratio
+        """
+        return (self.expected_return(allocs) - self.period_risk_free_rate) / self.volatility(allocs) * self.k
+
+    def statistics(self, allocs, chunk=100000):
+        """
+            Statistics of a batch of allocation vectors computed with matrix products
+        :param allocs: 2d array K x N, one allocation vector per row
+        :param chunk: rows per matrix product, limits temporary memory
+        :return: (returns, volatilities, Sharp ratios), arrays of K
+        """
+        allocs = np.atleast_2d(np.asarray(allocs, dtype=np.float64))
+        returns = allocs @ self.mean
+        variances = np.empty(len(allocs))
+        for start in range(0, len(allocs), chunk):
+            block = allocs[start:start + chunk]
+            variances[start:start + chunk] = np.einsum('ij,ij->i', block @ self.cov, block)
+        volatilities = np.sqrt(variances)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sharp_ratios = (returns - self.period_risk_free_rate) / volatilities * self.k
+        return returns, volatilities, sharp_ratios
+
+    def random_allocations(self, n, bounds, seed=None):
+        """
+            Random allocation vectors with |x|.sum() == 1: magnitudes are uniform on the simplex,
+            sign of a security is random if its bounds allow both signs.
+            Vectors outside bounds are dropped, so fewer than n vectors can be returned for tight bounds
+        :param n: number of vectors
+        :param bounds: list of (min, max) for every security
+        :param seed: seed of random generator
+        :return: 2d array n x N
+        """
+        rng = np.random.RandomState(seed)
+        lower = np.array([bound[0] for bound in bounds], dtype=np.float64)
+        upper = np.array([bound[1] for bound in bounds], dtype=np.float64)
+        allocs = rng.dirichlet(np.ones(len(bounds)), size=n)
+        both = (lower < 0) & (upper > 0)
+        signs = np.where(upper <= 0, -1.0, 1.0) * np.ones_like(allocs)
+        signs[:, both] = rng.choice((-1.0, 1.0), size=(n, both.sum()))
+        allocs *= signs
+        return allocs[np.all((allocs >= lower) & (allocs <= upper), axis=1)]
+
+    def monte_carlo(self, bounds, n=100000, labels=None, seed=None):
+        """
+            Statistics of random portfolios
+        :param bounds: list of (min, max) for every security
+        :param n: number of random allocation vectors
+        :param labels: names of securities
+        :param seed: seed of random generator
+        :return: DataFrame with columns 'return', 'volatility', 'sharp_ratio' and allocations
+        """
+        labels = list(labels) if labels is not None else list(range(len(self.mean)))
+        allocs = self.random_allocations(n, bounds, seed=seed)
+        returns, volatilities, sharp_ratios = self.statistics(allocs)
+        table = DataFrame(allocs, columns=labels)
+        table.insert(0, 'sharp_ratio', sharp_ratios)
+        table.insert(0, 'volatility', volatilities)
+        table.insert(0, 'return', returns)
+        return table
+
+    def _neg_sharp_ratio(self, allocs):
+        cov_x = self.cov @ allocs
+        vol = np.sqrt(allocs @ cov_x)
+        excess = allocs @ self.mean - self.period_risk_free_rate
+        value = -excess / vol * self.k
+        grad = -self.k * (self.mean * vol - excess * cov_x / vol) / vol ** 2
+        return value, grad
+
+    def _variance(self, allocs):
+        cov_x = self.cov @ allocs * self._variance_scale
+        return allocs @ cov_x, 2 * cov_x
+
+    def _solve(self, fun, x0, bounds, constraints=()):
+        return self._minimize(fun, x0, bounds, constraints).x
+
+    def _minimize(self, fun, x0, bounds, constraints=()):
+        """
+        :return: scipy.optimize.OptimizeResult of SLSQP under |x|.sum() == 1 and the given constraints
+        """
+        cons = [{'type': 'eq',
+                 'fun': lambda x: np.abs(x).sum() - 1,
+                 'jac': np.sign}]
+        cons.extend(constraints)
+        result = spo.minimize(fun, x0, jac=True, method='SLSQP', bounds=bounds, constraints=cons)
+        metrics.count('optimizer_runs_total', method='SLSQP')
+        metrics.count('optimizer_iterations_total', result.nit, method='SLSQP')
+        return result
+
+    def _initial_guess(self, bounds):
+        x0 = np.full(len(self.mean), 1.0 / len(self.mean))
+        return np.clip(x0, [b[0] for b in bounds], [b[1] for b in bounds])
+
+    def min_volatility(self, bounds, x0=None):
+        """
+        :param bounds: list of (min, max) for every security
+        :param x0: initial guess
+        :return: array of allocations
+        """
+        x0 = self._initial_guess(bounds) if x0 is None else x0
+        return self._solve(self._variance, x0, bounds)
+
+    def max_sharp_ratio(self, bounds, x0=None):
+        x0 = self._initial_guess(bounds) if x0 is None else x0
+        return self._solve(self._neg_sharp_ratio, x0, bounds)
+
+    def min_volatility_for_return(self, target, bounds, x0=None):
+        """
+            Min variance portfolio with the given mean daily return
+        """
+        x0 = self._initial_guess(bounds) if x0 is None else x0
+        cons = ({'type': 'eq',
+                 'fun': lambda x: (x @ self.mean - target) * self._return_scale,
+                 'jac': lambda x: self.mean * self._return_scale},)
+        return self._solve(self._variance, x0, bounds, cons)
+
+    def _max_return(self, bounds):
+        """
+            The highest mean daily return reachable within bounds and |x|.sum() == 1
+        """
+        return max(max(bound[1] * mean, bound[0] * mean) for bound, mean in zip(bounds, self.mean))
+
+    def frontier(self, bounds, points=20, labels=None):
+        """
+            Efficient frontier: min volatility for a grid of target returns between
+            min volatility portfolio and the highest reachable return, every solve is warm-started
+            from the previous point. Min volatility and max Sharp ratio points are included
+        :param bounds: list of (min, max) for every security
+        :param points: number of target returns
+        :param labels: names of securities
+        :return: DataFrame with columns 'point', 'return', 'volatility', 'sharp_ratio' and allocations
+        """
+        labels = list(labels) if labels is not None else list(range(len(self.mean)))
+        min_vol = self.min_volatility(bounds)
+        rows = [('min_volatility', min_vol),
+                ('max_sharp_ratio', self.max_sharp_ratio(bounds, x0=min_vol))]
+        x0 = min_vol
+        for target in np.linspace(self.expected_return(min_vol), self._max_return(bounds), points):
+            x0 = self.min_volatility_for_return(target, bounds, x0=x0)
+            rows.append(('frontier', x0))
+
+        table = DataFrame([x for _, x in rows], columns=labels)
+        table.insert(0, 'sharp_ratio', [self.sharp_ratio(x) for _, x in rows])
+        table.insert(0, 'volatility', [self.volatility(x) for _, x in rows])
+        table.insert(0, 'return', [self.expected_return(x) for _, x in rows])
+        table.insert(0, 'point', [name for name, _ in rows])
+        return table
@@ -0,0 +1,115 @@
+import os
+import pickle
+import threading
+
+
+class Security:
+    """
+        Lightweight metadata record, fields are available as attributes and by name like in pandas row
+    """
+    __slots__ = ('market_id', 'market_name', 'emitent_id', 'emitent_code', 'emitent_name')
+
+    def __init__(self, market_id, market_name, emitent_id, emitent_code, emitent_name):
+        self.market_id = market_id
+        self.market_name = market_name
+        self.emitent_id = emitent_id
+        self.emitent_code = emitent_code
+        self.emitent_name = emitent_name
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __setstate__(self, state):
+        for field, value in zip(self.__slots__, state):
+            setattr(self, field, value)
+
+    def __repr__(self):
+        return 'Security(%s)' % ', '.join('%s=%r' % (field, getattr(self, field)) for field in self.__slots__)
+
+
+class MetadataIndex:
+    """
+        Hashed lookups of securities by id, code, name and market.
+        Index is built once from metadata csv, cached in memory per process
+        and persisted as pickle next to the csv file
+    """
+    _cache = {}
+    _lock = threading.Lock()
+
+    def __init__(self, securities):
+        self.securities = securities
+        self._by_field = {field: {} for field in Security.__slots__}
+        for pos, sec in enumerate(securities):
+            for field in Security.__slots__:
+                self._by_field[field].setdefault(sec[field], []).append(pos)
+
+    @classmethod
+    def load(cls, fname):
+        """
+            Get index of metadata file, csv is parsed only if there is no up-to-date binary copy
+        :param fname: path to metadata csv
+        :return: MetadataIndex
+        """
+        mtime = os.path.getmtime(fname)
+        with cls._lock:
+            cached = cls._cache.get(fname)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+            binary_fname = os.path.splitext(fname)[0] + '.pkl'
+            if os.path.isfile(binary_fname) and os.path.getmtime(binary_fname) >= mtime:
+                with open(binary_fname, 'rb') as f:
+                    index = pickle.load(f)
+            else:
+                index = cls.from_csv(fname)
+                # readers of other processes never see a partly written copy
+                with open(binary_fname + '.tmp', 'wb') as f:
+                    pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(binary_fname + '.tmp', binary_fname)
+            cls._cache[fname] = (mtime, index)
+            return index
+
+    @classmethod
+    def from_csv(cls, fname):
+        # pandas is imported only if there is no binary copy
+        from pandas import read_csv
+        df = read_csv(fname, sep=';', dtype=str, keep_default_na=False)
+        securities = [Security(market_id=int(market_id),
+                               market_name=market_name,
+                               emitent_id=emitent_id,
+                               emitent_code=emitent_code.replace("'", ""),
+                               emitent_name=emitent_name)
+                      for market_id, market_name, emitent_id, emitent_code, emitent_name
+                      in zip(df.market_id, df.market_name, df.emitent_id, df.emitent_code, df.emitent_name)]
+        return cls(securities)
+
+    def __getstate__(self):
+        return self.securities
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def find(self, market_id=(), market_name=(), emitent_id=(), emitent_code=(), emitent_name=()):
+        """
+            Find securities matching any of the given values, duplicates by emitent_id are skipped
+        :return: list of Security in order of metadata file
+        """
+        keys = {'market_id': [int(id_) for id_ in market_id],
+                'market_name': market_name,
+                'emitent_id': [str(id_) for id_ in emitent_id],
+                'emitent_code': [str(code).replace("'", "") for code in emitent_code],
+                'emitent_name': emitent_name}
+        positions = set()
+        for field, values in keys.items():
+            for value in values:
+                positions.update(self._by_field[field].get(value, ()))
+
+        found, seen = [], set()
+        for pos in sorted(positions):
+            sec = self.securities[pos]
+            if sec.emitent_id not in seen:
+                seen.add(sec.emitent_id)
+                found.append(sec)
+        return found
@@ -0,0 +1,267 @@
+"""
+    Process-wide timers and counters of stages, HTTP requests, file reads, joins and optimizer.
+    Disabled by default, in this case every call returns after one flag check.
+    See config/metrics.yaml
+"""
+import os
+import json
+import time
+import atexit
+import threading
+import functools
+from contextlib import contextmanager
+import yaml
+
+PREFIX = 'pyfolio_'
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.report_fname = None
+        self.prometheus_fname = None
+        self.profile_engine = None
+        self.profile_stages = ()
+        self.profile_dir = 'metrics/profiles'
+        self._counters = {}
+        self._timers = {}
+        self._lock = threading.Lock()
+        self._profiling = False
+        self._exit_registered = False
+
+    def configure(self, config):
+        """
+        :param config: dict like config/metrics.yaml
+        """
+        config = config or {}
+        profile = config.get('profile') or {}
+        self.enabled = bool(config.get('enabled', False))
+        self.report_fname = config.get('report')
+        self.prometheus_fname = config.get('prometheus')
+        self.profile_engine = profile.get('engine')
+        self.profile_stages = profile.get('stages') or ()
+        self.profile_dir = profile.get('directory', self.profile_dir)
+        if self.enabled and not self._exit_registered:
+            atexit.register(self.save)
+            self._exit_registered = True
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def count(self, name, value=1, **labels):
+        """
+            Add value to counter
+        """
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """
+            Add duration to timer, count, sum, min and max are kept
+        """
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            timer = self._timers.get(key)
+            if timer is None:
+                self._timers[key] = [1, seconds, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = min(timer[2], seconds)
+                timer[3] = max(timer[3], seconds)
+
+    @contextmanager
+    def _timer(self, name, labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timer(self, name, **labels):
+        """
+            Context manager measuring duration of the block
+        """
+        if not self.enabled:
+            return _NULL
+        return self._timer(name, labels)
+
+    @contextmanager
+    def _stage(self, name):
+        profiler = self._start_profiler(name)
+        try:
+            with self._timer('stage_seconds', {'stage': name}):
+                yield
+        finally:
+            if profiler is not None:
+                self._stop_profiler(name, profiler)
+
+    def stage(self, name):
+        """
+            Context manager measuring a stage like 'load', 'save', 'read' or 'optimize',
+            the stage is profiled if it is listed in profile stages.
+            Nested stages are timed but profiled as a part of the outer one
+        """
+        if not self.enabled:
+            return _NULL
+        return self._stage(name)
+
+    def _start_profiler(self, name):
+        if not self.profile_engine or name not in self.profile_stages:
+            return None
+        with self._lock:
+            if self._profiling:
+                return None
+            self._profiling = True
+        if self.profile_engine == 'pyinstrument':
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+        elif self.profile_engine == 'cprofile':
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            self._profiling = False
+            raise ValueError("Unknown profile engine %s" % self.profile_engine)
+        return profiler
+
+    def _stop_profiler(self, name, profiler):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        fname = os.path.join(self.profile_dir, '%s_%u_%s' % (name, os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+        if self.profile_engine == 'pyinstrument':
+            profiler.stop()
+            with open(fname + '.html', 'w') as f:
+                f.write(profiler.output_html())
+        else:
+            profiler.disable()
+            profiler.dump_stats(fname + '.prof')
+        self._profiling = False
+
+    def report(self):
+        """
+        :return: dict {'counters': [...], 'timers': [...]}
+        """
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            timers = [{'name': name, 'labels': dict(labels), 'count': count, 'sum': total,
+                       'min': min_, 'max': max_, 'mean': total / count}
+                      for (name, labels), (count, total, min_, max_) in sorted(self._timers.items())]
+        return {'pid': os.getpid(), 'counters': counters, 'timers': timers}
+
+    def to_prometheus(self):
+        """
+            Prometheus text exposition format, timers are summaries without quantiles
+        :return: str
+        """
+        report = self.report()
+        lines = []
+        for kind, items in (('counter', report['counters']), ('summary', report['timers'])):
+            typed = set()
+            for item in items:
+                name = PREFIX + item['name']
+                if name not in typed:
+                    lines.append('# TYPE %s %s' % (name, kind))
+                    typed.add(name)
+                labels = _format_labels(item['labels'])
+                if kind == 'counter':
+                    lines.append('%s%s %r' % (name, labels, item['value']))
+                else:
+                    lines.append('%s_count%s %d' % (name, labels, item['count']))
+                    lines.append('%s_sum%s %r' % (name, labels, item['sum']))
+        return '\n'.join(lines) + '\n'
+
+    def save(self):
+        """
+            Write report and Prometheus files if they are configured, '{pid}' in names is replaced by process id
+        """
+        if self.report_fname:
+            _write(self.report_fname.format(pid=os.getpid()), json.dumps(self.report(), indent=2))
+        if self.prometheus_fname:
+            _write(self.prometheus_fname.format(pid=os.getpid()), self.to_prometheus())
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+
+
+class _NullContext:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _NullContext()
+registry = Metrics()
+_configured = False
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in sorted(labels.items()))
+
+
+def _write(fname, text):
+    if os.path.dirname(fname):
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with open(fname + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(fname + '.tmp', fname)
+
+
+def setup(default_path='config/metrics.yaml', env_key='METRICS_CFG'):
+    """
+        Configure the registry once per process
+    :return: Metrics
+    """
+    global _configured
+    if not _configured:
+        path = os.getenv(env_key, None) or default_path
+        if os.path.exists(path):
+            with open(path, 'rt') as f:
+                registry.configure(yaml.safe_load(f.read()))
+        _configured = True
+    return registry
+
+
+def count(name, value=1, **labels):
+    registry.count(name, value, **labels)
+
+
+def observe(name, seconds, **labels):
+    registry.observe(name, seconds, **labels)
+
+
+def timer(name, **labels):
+    return registry.timer(name, **labels)
+
+
+def stage(name):
+    return registry.stage(name)
+
+
+def staged(name):
+    """
+        Decorator running the method as a stage
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return func(*args, **kwargs)
+            with registry.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
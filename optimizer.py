@@ -0,0 +1,116 @@
+import numpy as np
+from kernels import normalize
+from kernels import as_float
+import metrics
+from utilites import lazy_import
+
+spo = lazy_import('scipy.optimize')
+
+
+class SharpeObjective:
+    """
+        Negative annualized Sharp ratio of a portfolio and its gradient computed with NumPy only.
+        It is the negative Sharp ratio of Portfolio.daily_portfolio_values: portfolio value is
+        start_value * sum(allocs * normed prices) where short positions are valued by (normed price - 2),
+        daily returns include zero return of the first day.
+        Normed price matrix is prepared once, every evaluation costs two matrix-vector products
+    """
+    def __init__(self, prices, start_value, risk_free_rate, samples_per_year=252):
+        """
+        :param prices: 2d array-like T x N of prices or normed prices
+        :param start_value: initial value of portfolio
+        :param risk_free_rate: annual risk free rate
+        :param samples_per_year: daily=252, weekly=52, monthly=12
+        """
+        # float32 and memory-mapped prices are converted once
+        prices = np.asarray(prices)
+        if np.all(prices[0, :] == 1):
+            self.normed = as_float(prices)
+        else:
+            self.normed = normalize(prices)
+        self.start_value = start_value
+        self.period_risk_free_rate = (risk_free_rate + 1) ** (1 / samples_per_year) - 1
+        self.k = np.sqrt(samples_per_year)
+        self._x = None
+        self._result = None
+
+    def portfolio_values(self, allocs):
+        """
+        :param allocs: array of allocations
+        :return: array of daily portfolio values
+        """
+        allocs = np.asarray(allocs, dtype=np.float64)
+        short_offset = -2 * allocs[allocs < 0].sum()
+        return self.start_value * (self.normed @ allocs + short_offset)
+
+    def _evaluate(self, x):
+        """
+            Value and gradient are computed together and cached for the last x,
+            SLSQP asks for them one after another
+        """
+        if self._x is not None and np.array_equal(x, self._x):
+            return self._result
+        metrics.count('objective_evaluations_total')
+        x = np.array(x, dtype=np.float64)
+        normed = self.normed
+        values = self.portfolio_values(x)
+        returns = values[1:] / values[:-1] - 1
+        n = len(values)
+
+        excess = np.concatenate(([0.0], returns)) - self.period_risk_free_rate
+        mean = excess.mean()
+        std = excess.std(ddof=1)
+        sharp_ratio = mean / std * self.k
+
+        # d(sharp_ratio)/d(return_t) for t >= 1, return of the first day doesn't depend on x
+        weights = self.k * (1 / (n * std) - mean * (excess[1:] - mean) / ((n - 1) * std ** 3))
+        # d(return_t)/dx = start_value * (q_t - (1 + return_t) * q_(t-1)) / value_(t-1),
+        # where q_t = normed_t - 2 * (x < 0)
+        a = weights * self.start_value / values[:-1]
+        b = a * (1 + returns)
+        grad = a @ normed[1:] - b @ normed[:-1] - 2 * (x < 0) * (a.sum() - b.sum())
+
+        self._x = x
+        self._result = (-sharp_ratio, -grad)
+        return self._result
+
+    def fun(self, x):
+        return self._evaluate(x)[0]
+
+    def jac(self, x):
+        return self._evaluate(x)[1]
+
+    @staticmethod
+    def constraint(x):
+        return np.abs(x).sum() - 1
+
+    @staticmethod
+    def constraint_jac(x):
+        return np.sign(x)
+
+
+def maximize_sharp_ratio(prices, bounds, start_value, risk_free_rate, disp=False):
+    """
+        Maximize Sharp ratio with SLSQP, objective and constraint have analytic gradients
+    :param prices: 2d array-like T x N of prices or normed prices
+    :param bounds: list of (min, max) for every security
+    :param start_value: initial value of portfolio
+    :param risk_free_rate: annual risk free rate
+    :param disp: print convergence messages
+    :return: array of allocations
+    """
+    objective = SharpeObjective(prices, start_value, risk_free_rate)
+    n = objective.normed.shape[1]
+    # short positions start from -1/n, long ones from 1/n, so the guess is inside bounds
+    initial_guess = np.array([-1.0 / n if bound[0] < 0 else 1.0 / n for bound in bounds])
+    cons = ({'type': 'eq', 'fun': objective.constraint, 'jac': objective.constraint_jac})
+    result = spo.minimize(objective.fun,
+                          initial_guess,
+                          jac=objective.jac,
+                          method='SLSQP',
+                          options={'disp': disp},
+                          constraints=cons,
+                          bounds=bounds)
+    metrics.count('optimizer_runs_total', method='SLSQP')
+    metrics.count('optimizer_iterations_total', result.nit, method='SLSQP')
+    return result.x
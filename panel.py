@@ -0,0 +1,134 @@
+import os
+import json
+import numpy as np
+from pandas import DataFrame
+from pandas import DatetimeIndex
+
+
+class Panel:
+    """
+        Compact price panel: one T x N matrix (float32 by default) with a separate date index and column catalog.
+        On disk it is <path>.dat with the raw matrix in C order, <path>.idx.npy with dates as int64 nanoseconds
+        and <path>.json with dtype, shape and columns; the matrix is memory-mapped, so only touched pages are loaded.
+        Frames of contiguous columns are zero-copy views of the matrix
+    """
+    def __init__(self, values, index, columns, path=None):
+        """
+        :param values: 2d array or np.memmap T x N
+        :param index: DatetimeIndex of T dates
+        :param columns: list of N column names
+        :param path: path without extension if the panel is stored
+        """
+        assert values.shape == (len(index), len(columns)), "Shape of values doesn't match index and columns"
+        self.values = values
+        self.index = index
+        self.columns = list(columns)
+        self.path = path
+        self._positions = {col: pos for pos, col in enumerate(self.columns)}
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    @staticmethod
+    def _fnames(path):
+        return path + '.dat', path + '.idx.npy', path + '.json'
+
+    @classmethod
+    def create(cls, path, index, columns, dtype='float32'):
+        """
+            Allocate a writable memory-mapped panel filled with NaN
+        :param path: path without extension, directory is created if it doesn't exist
+        :param index: DatetimeIndex
+        :param columns: list of column names
+        :param dtype: 'float32' or 'float64'
+        :return: Panel
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        data_fname, index_fname, meta_fname = cls._fnames(path)
+        shape = (len(index), len(columns))
+        values = np.memmap(data_fname, dtype=dtype, mode='w+', shape=shape) if shape[0] * shape[1] \
+            else np.empty(shape, dtype=dtype)
+        values[:] = np.nan
+        # asi8 isn't in nanoseconds for other units of newer pandas
+        np.save(index_fname, np.asarray(DatetimeIndex(index), dtype='datetime64[ns]').view(np.int64))
+        with open(meta_fname, 'w') as f:
+            json.dump({'dtype': np.dtype(dtype).name, 'shape': shape, 'columns': list(columns)}, f)
+        return cls(values, index, columns, path=path)
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        """
+        :param path: path without extension
+        :param mode: 'r' read only, 'r+' writable, 'c' copy on write
+        :return: Panel
+        """
+        data_fname, index_fname, meta_fname = cls._fnames(path)
+        with open(meta_fname, 'r') as f:
+            meta = json.load(f)
+        shape = tuple(meta['shape'])
+        if shape[0] * shape[1]:
+            values = np.memmap(data_fname, dtype=meta['dtype'], mode=mode, shape=shape)
+        else:
+            values = np.empty(shape, dtype=meta['dtype'])
+        return cls(values, DatetimeIndex(np.load(index_fname)), meta['columns'], path=path)
+
+    @classmethod
+    def from_frame(cls, df, path=None, dtype='float32'):
+        """
+        :param df: DataFrame with datetime index
+        :param path: path without extension, in-memory panel if None
+        :param dtype: 'float32' or 'float64'
+        :return: Panel
+        """
+        if path is None:
+            return cls(np.ascontiguousarray(df.values, dtype=dtype), df.index, df.columns)
+        panel = cls.create(path, df.index, df.columns, dtype=dtype)
+        panel.values[:] = df.values
+        panel.flush()
+        return panel
+
+    def flush(self):
+        if isinstance(self.values, np.memmap):
+            self.values.flush()
+
+    def positions(self, columns):
+        """
+        :param columns: list of column names
+        :return: slice if columns are contiguous and in order, otherwise list of positions
+        """
+        positions = [self._positions[col] for col in columns]
+        if positions and positions == list(range(positions[0], positions[0] + len(positions))):
+            return slice(positions[0], positions[-1] + 1)
+        return positions
+
+    def view(self, columns=None, start=None, end=None):
+        """
+            Matrix of the columns between dates, it is a view without copying
+            if columns are contiguous, otherwise the selected columns are copied
+        :param columns: list of column names, all columns by default
+        :param start: first date
+        :param end: last date
+        :return: 2d array
+        """
+        rows = self.index.slice_indexer(start, end) if start is not None or end is not None else slice(None)
+        cols = slice(None) if columns is None else self.positions(columns)
+        return self.values[rows, cols]
+
+    def to_frame(self, columns=None, start=None, end=None):
+        """
+            DataFrame over the view of the panel, see view
+        :return: DataFrame
+        """
+        rows = self.index.slice_indexer(start, end) if start is not None or end is not None else slice(None)
+        columns = self.columns if columns is None else list(columns)
+        return DataFrame(self.view(columns, start, end), index=self.index[rows], columns=columns, copy=False)
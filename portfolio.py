@@ -3,13 +3,29 @@ from reader import Reader
 from datetime import datetime, timedelta
 import os
 import numpy as np
-import scipy.optimize as spo
-from utilites import normalize_data
+from pandas import Series
+from pandas import DataFrame
+from pandas import concat
+from kernels import dot
+from panel import Panel
 from utilites import compute_daily_returns
+from optimizer import maximize_sharp_ratio
+from meanvar import MeanVariance
+from constraints import Constraints
+from constraints import ConstrainedOptimizer
+from backtest import Backtest
+import risk
+import metrics
 
 
 class Portfolio(Base):
-    def __init__(self, config, optimize=True):
+    def __init__(self, config, optimize=True, data=None):
+        """
+        :param config: name of config file in config/portfolios/ without extension
+        :param optimize: find allocations with max Sharp ratio
+        :param data: prepared DataFrame or Panel of prices with '_Ref' column, by default it is read by Reader.
+                     Prices of Panel are zero-copy views if the reference column is the last one
+        """
         Base.__init__(self, config, path="config/portfolios/")
 
         self.market_id = self._get_list_sec('market_id')
@@ -17,12 +33,17 @@ class Portfolio(Base):
         self.emitent_id = self._get_list_sec('emitent_id')
         self.emitent_code = self._get_list_sec('emitent_code')
         self.emitent_name = self._get_list_sec('emitent_name')
-        self.start_date = self._get_start_date()
+        self.start_date = self._get_start_date(self.config)
         self.end_date = self._get_end_date()
-        self.data = self._get_data()
-        self.prices = self.data[[col for col in self.data.columns if '_Ref' not in col]]
-        self.price_ref = self.data[[col for col in self.data.columns if '_Ref' in col]]
-        self.error_func = self._minimize_function
+        self.data = self._get_data() if data is None else data
+        prices = [col for col in self.data.columns if '_Ref' not in col]
+        price_ref = [col for col in self.data.columns if '_Ref' in col]
+        if isinstance(self.data, Panel):
+            self.prices = self.data.to_frame(prices)
+            self.price_ref = self.data.to_frame(price_ref)
+        else:
+            self.prices = self.data[prices]
+            self.price_ref = self.data[price_ref]
 
         self.logger.info("[%u] Portfolio '%s' is ready:" % (os.getpid(), self.config['name']))
         print('Start date: ', self.start_date)
@@ -32,7 +53,8 @@ class Portfolio(Base):
         if optimize:
             self.allocs = self._optimize()
             print("Allocations:", self.allocs*100)
-            cr, adr, sddr, sr = self.get_portfolio_statistics(self.daily_portfolio_values(self.allocs))
+            self.statistics = self.get_portfolio_statistics(self.daily_portfolio_values(self.allocs))
+            cr, adr, sddr, sr = self.statistics
             print("Sharpe Ratio:", sr)
             print("Volatility (stdev of daily returns):", sddr)
             print("Average Daily Return:", adr)
@@ -51,25 +73,139 @@ class Portfolio(Base):
 
         return cum_ret, avg_daily_ret, std_daily_ret, sharp_ratio
 
-    def daily_portfolio_values(self, allocs):
+    def _check_prices(self):
         if np.any(self.prices.values[0, :] == 0):
             self.logger.error("[%u] Normed prices are needed instead of daily return" %
                               os.getpid())
             print(self.prices.head(3))
             raise SystemExit(1)
-        elif np.all(self.prices.values[0, :] != 1):
-            normed = normalize_data(self.prices)
+
+    def daily_portfolio_values(self, allocs):
+        """
+            Value of portfolio is start_value * sum(allocs * normed prices),
+            short positions are valued by (normed price - 2).
+            Normalization is folded into allocations, so prices aren't copied
+        :param allocs: array of allocations
+        :return: Series of daily portfolio values
+        """
+        self._check_prices()
+        return Series(self._values(allocs)[:, 0], index=self.prices.index)
+
+    def _values(self, allocs):
+        """
+        :param allocs: 1d array N or 2d array K x N of allocations
+        :return: 2d array T x K of portfolio values
+        """
+        prices = self.prices.values
+        allocs = np.atleast_2d(np.asarray(allocs, dtype=np.float64))
+        if np.all(prices[0, :] == 1):
+            weights = allocs
         else:
-            normed = self.prices.copy()
+            weights = allocs / prices[0, :]
+        short_offsets = -2 * np.where(allocs < 0, allocs, 0).sum(axis=1)
+        return self.config['start_value'] * (dot(prices, weights.T) + short_offsets)
 
-        for i, alloc in enumerate(allocs):
-            if alloc < 0:
-                normed.values[:, i] = normed.values[:, i] - 2
+    def _chunk_size(self, max_bytes):
+        """
+        :return: number of allocation vectors whose values and returns fit into max_bytes
+        """
+        return max(1, int(max_bytes // (2 * 8 * max(1, self.prices.shape[0]))))
 
-        alloced = normed * allocs
-        pos_val = alloced * self.config['start_value']
-        port_val = pos_val.sum(axis=1)
-        return port_val
+    def batch_portfolio_values(self, allocs, max_bytes=256 * 2 ** 20):
+        """
+            Daily values of many portfolios, the same as daily_portfolio_values for every row of allocs
+        :param allocs: 2d array K x N, one allocation vector per row
+        :param max_bytes: limit of temporary arrays of one chunk of allocation vectors
+        :return: DataFrame T x K
+        """
+        self._check_prices()
+        allocs = np.atleast_2d(np.asarray(allocs, dtype=np.float64))
+        values = np.empty((self.prices.shape[0], len(allocs)))
+        chunk = self._chunk_size(max_bytes)
+        for start in range(0, len(allocs), chunk):
+            values[:, start:start + chunk] = self._values(allocs[start:start + chunk])
+        return DataFrame(values, index=self.prices.index, copy=False)
+
+    def batch_statistics(self, allocs, max_bytes=256 * 2 ** 20, samples_per_year=252):
+        """
+            The same as get_portfolio_statistics(daily_portfolio_values(x)) for every row of allocs,
+            allocation vectors are evaluated by chunks, values of a chunk are released after its statistics
+        :param allocs: 2d array K x N, one allocation vector per row
+        :param max_bytes: limit of temporary arrays of one chunk of allocation vectors
+        :param samples_per_year: daily=252, weekly=52, monthly=12
+        :return: DataFrame K x ('cum_ret', 'avg_daily_ret', 'std_daily_ret', 'sharp_ratio')
+        """
+        self._check_prices()
+        allocs = np.atleast_2d(np.asarray(allocs, dtype=np.float64))
+        period_risk_free_rate = (self.config['risk_free_rate'] + 1) ** (1 / samples_per_year) - 1
+        stats = np.empty((len(allocs), 4))
+        chunk = self._chunk_size(max_bytes)
+        for start in range(0, len(allocs), chunk):
+            values = self._values(allocs[start:start + chunk])
+            returns = values[1:] / values[:-1] - 1
+            avg = returns.mean(axis=0)
+            std = returns.std(axis=0, ddof=1)
+            block = stats[start:start + chunk]
+            block[:, 0] = values[-1] / values[0] - 1
+            block[:, 1] = avg
+            block[:, 2] = std
+            block[:, 3] = (avg - period_risk_free_rate) / std * np.sqrt(samples_per_year)
+        self.logger.info("[%u] %d allocations of '%s' have been evaluated" %
+                         (os.getpid(), len(allocs), self.config['name']))
+        return DataFrame(stats, columns=['cum_ret', 'avg_daily_ret', 'std_daily_ret', 'sharp_ratio'])
+
+    def risk_statistics(self, allocs=None, confidence=None, max_bytes=256 * 2 ** 20):
+        """
+            VaR, CVaR, drawdown, Sortino ratio and beta against the reference of every row of allocs,
+            defaults are taken from 'risk' section of portfolio config
+        :param allocs: 1d array N or 2d array K x N, optimized allocations by default
+        :param confidence: confidence level of VaR and CVaR
+        :param max_bytes: limit of portfolio values of one chunk of allocation vectors
+        :return: DataFrame K x risk.SUMMARY
+        """
+        self._check_prices()
+        allocs = np.atleast_2d(np.asarray(self.allocs if allocs is None else allocs, dtype=np.float64))
+        params = self._get_risk_params(confidence)
+        chunk = self._chunk_size(max_bytes)
+        table = concat([risk.summary(self._values(allocs[start:start + chunk]),
+                                     reference=self._get_risk_reference(),
+                                     labels=range(start, min(start + chunk, len(allocs))),
+                                     **params)
+                        for start in range(0, len(allocs), chunk)])
+        self.logger.info("[%u] Risk of %d allocations of '%s' has been evaluated" %
+                         (os.getpid(), len(allocs), self.config['name']))
+        return table
+
+    def rolling_risk(self, allocs=None, window=None, confidence=None):
+        """
+            Risk metrics over rolling windows, defaults are taken from 'risk' section of portfolio config
+        :param allocs: 1d array N or 2d array K x N, optimized allocations by default
+        :param window: number of daily returns in a window
+        :param confidence: confidence level of VaR and CVaR
+        :return: DataFrame T x risk.ROLLING for 1d allocs, otherwise T x (metric, portfolio)
+        """
+        self._check_prices()
+        allocs = self.allocs if allocs is None else allocs
+        table = risk.rolling(self._values(allocs),
+                             window or self.config.get('risk', {}).get('window', 63),
+                             reference=self._get_risk_reference(),
+                             index=self.prices.index,
+                             **self._get_risk_params(confidence))
+        if np.ndim(allocs) == 1:
+            table.columns = table.columns.droplevel('portfolio')
+        return table
+
+    def _get_risk_params(self, confidence=None):
+        return dict(risk_free_rate=self.config['risk_free_rate'],
+                    confidence=confidence or self.config.get('risk', {}).get('confidence', 0.95))
+
+    def _get_risk_reference(self):
+        """
+        :return: prices of '_Ref' column or None if there is no reference
+        """
+        if self.price_ref.shape[1] == 0:
+            return None
+        return self.price_ref.values[:, 0]
 
     @staticmethod
     def compute_daily_returns(df):
@@ -90,18 +226,8 @@ class Portfolio(Base):
         s_annualized = s * k
         return s_annualized
 
-    def _minimize_function(self, allocs):
-        port_val = self.daily_portfolio_values(allocs)
-        port_daily_ret = self.compute_daily_returns(port_val)
-        sharp_ratio = self.get_sharp_ratio(port_daily_ret)
-        return sharp_ratio * -1
-
-    def _optimize(self):
-
-        def constraint(x):
-            return np.abs(x).sum() - 1
-
-        bounds=[]
+    def _get_bounds(self):
+        bounds = []
         key = list(self.config['securities'].keys())[0]
         for sec in self.config['securities'][key]:
             if sec != self.config['reference'][key]:
@@ -109,28 +235,124 @@ class Portfolio(Base):
                     bounds.append((-1, 1))
                 else:
                     bounds.append((0, 1))
+        return bounds
+
+    @metrics.staged('optimize')
+    def _optimize(self):
+        """
+            Maximize Sharp ratio of buy-and-hold portfolio values with SLSQP, objective and constraint
+            have analytic gradients. If config has 'constraints' section, Sharp ratio of daily rebalanced
+            mean-variance model is maximized under them instead, so even a section without binding limits
+            can change allocations
+        :return: array of allocations
+        """
+        self._check_prices()
+        if self.config.get('constraints'):
+            return self._optimize_constrained()
+        return maximize_sharp_ratio(self.prices.values,
+                                    self._get_bounds(),
+                                    self.config['start_value'],
+                                    self.config['risk_free_rate'],
+                                    disp=True)
+
+    def _optimize_constrained(self, previous=None):
+        """
+            Maximize Sharp ratio of mean-variance model under 'constraints' section of config,
+            see Constraints.from_config. Solver is taken from 'solver' key: auto (cvxpy if installed), cvxpy or slsqp.
+            Infeasible allocations are logged, with 'strict: true' ValueError is raised instead
+        :param previous: dict {column: allocation} of previous allocations instead of the ones from config
+        :return: array of allocations
+        """
+        config = dict(self.config.get('constraints') or {})
+        self.logger.info("[%u] Allocations of '%s' maximize Sharp ratio of daily rebalanced mean-variance model "
+                         "under constraints, not of buy-and-hold portfolio values" %
+                         (os.getpid(), self.config['name']))
+        if previous is not None:
+            config['previous'] = dict(previous)
+        securities = {}
+        if config.get('groups'):
+            securities = {sec['emitent_code']: sec for _, sec in self._get_reader()._find_securities()}
+        constraints = Constraints.from_config(config, self._get_bounds(), list(self.prices.columns), securities)
+        optimizer = ConstrainedOptimizer(self._get_model(), constraints)
+        allocs = optimizer.solve(config.get('solver', 'auto'), strict=config.get('strict', False))
+        for error in optimizer.errors:
+            self.logger.warning("[%u] Constraints of '%s' aren't satisfied by %s: %s" %
+                                (os.getpid(), self.config['name'], optimizer.solver, error))
+        self.logger.info("[%u] Constrained allocations of '%s' have been found by %s" %
+                         (os.getpid(), self.config['name'], optimizer.solver))
+        return allocs
+
+    def rebalance(self, previous):
+        """
+            Allocations under 'constraints' section of config with turnover and transaction costs
+            counted against the given allocations
+        :param previous: dict {column: allocation} or array of current allocations
+        :return: array of allocations
+        """
+        self._check_prices()
+        if not isinstance(previous, dict):
+            previous = dict(zip(self.prices.columns, previous))
+        return self._optimize_constrained(previous)
+
+    def efficient_frontier(self, points=20):
+        """
+            Compute efficient frontier, mean returns and covariance matrix are computed once
+        :param points: number of target returns
+        :return: DataFrame with columns 'point', 'return', 'volatility', 'sharp_ratio' and allocations
+        """
+        frontier = self._get_model().frontier(self._get_bounds(), points=points, labels=self.prices.columns)
+        self.logger.info("[%u] Efficient frontier of '%s' has %d points" %
+                         (os.getpid(), self.config['name'], frontier.shape[0]))
+        return frontier
+
+    def monte_carlo(self, n=100000, seed=None):
+        """
+            Statistics of random allocation vectors within bounds, computed from mean returns and covariance matrix
+        :param n: number of random allocation vectors
+        :param seed: seed of random generator
+        :return: DataFrame with columns 'return', 'volatility', 'sharp_ratio' and allocations
+        """
+        table = self._get_model().monte_carlo(self._get_bounds(), n=n, labels=self.prices.columns, seed=seed)
+        self.logger.info("[%u] %d random portfolios of '%s' have been evaluated" %
+                         (os.getpid(), table.shape[0], self.config['name']))
+        return table
 
-        same_avg = 1.0 / len(self.prices.columns)
-        initial_guess = np.full((len(self.prices.columns)), -same_avg)
-        cons = ({'type': 'eq', 'fun': constraint})
-        #bounds = ((0, 1),) * len(self.prices.columns)
-        result = spo.minimize(self.error_func,
-                              initial_guess,
-                              # args=(self.prices, self.config['start_value']),
-                              method='SLSQP',
-                              options={'disp': True},
-                              constraints=cons,
-                              bounds=bounds)
-        return result.x
+    def _get_model(self):
+        """
+            Mean-variance model, covariance estimator is taken from 'covariance' section of config
+            like {estimator: ledoit_wolf} or {estimator: ewma, ewma_decay: 0.94}, sample covariance by default
+        :return: MeanVariance
+        """
+        self._check_prices()
+        params = self.config.get('covariance') or {}
+        return MeanVariance(self.prices.values,
+                            self.config['risk_free_rate'],
+                            estimator=params.get('estimator', 'sample'),
+                            ewma_decay=params.get('ewma_decay', 0.94))
+
+    def backtest(self, window=None, step=None, workers=None):
+        """
+            Walk-forward backtest, defaults are taken from 'backtest' section of portfolio config
+        :param window: number of rows used for optimization
+        :param step: number of rows between rebalancing
+        :param workers: number of processes
+        :return: (allocations, portfolio values, (cum_ret, avg_daily_ret, std_daily_ret, sharp_ratio))
+        """
+        params = self.config.get('backtest', {})
+        return Backtest(self,
+                        window=window or params.get('window', 252),
+                        step=step or params.get('step', 21),
+                        workers=workers or params.get('workers')).run()
 
     def _get_end_date(self):
         if self.config['end_date'] is None:
             end_date = datetime.now().strftime('%Y-%m-%d')
             return end_date
 
-    def _get_start_date(self):
-        if 'period' in self.config:
-            shift = [int(s) for s in self.config['period'].split() if s.isdigit()][0]
+    @staticmethod
+    def _get_start_date(config):
+        if 'period' in config:
+            shift = [int(s) for s in config['period'].split() if s.isdigit()][0]
             shift_date = (datetime.today() - timedelta(shift)).strftime('%Y-%m-%d')
             return shift_date
 
@@ -140,12 +362,25 @@ class Portfolio(Base):
             return {}
 
     def _get_data(self):
+        """
+            Read prices, if config has 'panel' section like {path: panels/name, dtype: float32}
+            they are stored in memory-mapped Panel
+        """
+        if self.config.get('panel'):
+            return self._get_reader().read_panel(path=self.config['panel']['path'],
+                                                 dtype=self.config['panel'].get('dtype', 'float32'),
+                                                 **self._get_read_params())
+        return self._get_reader().read(**self._get_read_params())
+
+    def _get_reader(self):
         return Reader(market_id=list(self.market_id.keys()),
                       market_name=list(self.market_name.keys()),
                       emitent_id=list(self.emitent_id.keys()),
                       emitent_code=list(self.emitent_code.keys()),
-                      emitent_name=list(self.emitent_name.keys())) \
-            .read(reference=self.config['reference'], dfrom=self.start_date, dto=self.config['end_date'],
-                  price=self.config['price'], volume=self.config['volume'],
-                  download_if_not_exists=self.config['download_if_not_exists'], normed=self.config['normed'],
-                  daily_returns=self.config['daily_returns'])
+                      emitent_name=list(self.emitent_name.keys()))
+
+    def _get_read_params(self):
+        return dict(reference=self.config['reference'], dfrom=self.start_date, dto=self.config['end_date'],
+                    price=self.config['price'], volume=self.config['volume'],
+                    download_if_not_exists=self.config['download_if_not_exists'], normed=self.config['normed'],
+                    daily_returns=self.config['daily_returns'])
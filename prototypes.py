@@ -1,4 +1,5 @@
 import log
+import metrics
 from config import Config
 import os
 
@@ -8,6 +9,8 @@ class Base:
         # Prepare logger
         log.setup()
         self.logger = log.logging.getLogger(name)
+        # Timers and counters, see config/metrics.yaml
+        self.metrics = metrics.setup()
 
         # Read config
         fname = name + '.yaml'
@@ -2,10 +2,12 @@ from prototypes import Base
 from loader import Loader
 from utilites import get_the_newest_fname
 from utilites import get_path
+from storage import get_storage
+from readcache import ReadCache
 from datetime import datetime
 import os
 import sys
-from pandas import read_csv
+from metaindex import MetadataIndex
 
 
 class QuotesIO(Base):
@@ -27,6 +29,8 @@ class QuotesIO(Base):
         self.tf_index, self.tf_symbol = self._get_timeframe()
         # TODO take out dirname to config
         self.quote_dir = 'quotes'
+        self.storage = get_storage(self.config.get('storage', {}).get('backend', 'csv'))
+        self.read_cache = ReadCache(**self.config.get('cache', {'enabled': False}))
 
     def _get_timeframe(self):
         symbol = self.config['request']['period']
@@ -47,25 +51,19 @@ class QuotesIO(Base):
     def _get_metadata(self):
         fname = self._get_metadata_fname()
         try:
-            df = read_csv(fname, sep=';')
-            return df
+            return MetadataIndex.load(fname)
         except Exception as e:
             self.logger.error('[%u] %s' % (os.getpid(), e))
             sys.exit(1)
 
     def _find_securities(self):
-        df = self._get_metadata()
-        res = df[
-            (df.market_id.isin(self.market_id)) |
-            (df.market_name.isin(self.market_name)) |
-            (df.emitent_id.isin(map(str, self.emitent_id))) |
-            (df.emitent_code.isin(self.emitent_code)) |
-            (df.emitent_name.isin(self.emitent_name))].copy()
-        res['emitent_code'] = res.emitent_code.apply(lambda x: x.replace("'", ""))
-        res.index = range(res.shape[0])
-        self.logger.info("[%u] Found %s securities" % (os.getpid(), res.shape[0]))
-        res.drop_duplicates(subset=['emitent_id'], keep='first', inplace=True)
-        return res.iterrows()
+        res = self._get_metadata().find(market_id=self.market_id,
+                                        market_name=self.market_name,
+                                        emitent_id=self.emitent_id,
+                                        emitent_code=self.emitent_code,
+                                        emitent_name=self.emitent_name)
+        self.logger.info("[%u] Found %s securities" % (os.getpid(), len(res)))
+        return enumerate(res)
 
     def _get_todate(self):
         if self.mode == 'update':
@@ -75,18 +73,24 @@ class QuotesIO(Base):
             to_date[2], to_date[0] = to_date[0], to_date[2]
         return to_date
 
+    def _quote_fname(self, sec):
+        return self._make_fname(sec,
+                                self.tf_symbol,
+                                self.quote_dir,
+                                self._get_todate(),
+                                ext=self.storage.ext)
+
     @staticmethod
-    def _make_fname(sec, tf, directory, to_date, mode='full_path'):
+    def _make_fname(sec, tf, directory, to_date, mode='full_path', ext='.csv'):
         directory = get_path(directory)
         to_date.reverse()
-        sec.emitent_name = sec.emitent_name.replace('/', '_')
         fname = '_'.join((str(sec.market_id),
                           sec.market_name,
                           str(sec.emitent_id),
                           sec.emitent_code,
-                          sec.emitent_name,
+                          sec.emitent_name.replace('/', '_'),
                           tf,
-                          '-'.join(to_date))) + '.csv'
+                          '-'.join(to_date))) + ext
         if mode == 'full_path':
             fname = directory + fname
         elif mode == 'dir_only':
@@ -0,0 +1,132 @@
+import os
+import glob
+import pickle
+import hashlib
+import fnmatch
+import threading
+from collections import OrderedDict
+from utilites import create_folder_if_not_exists
+
+
+class ReadCache:
+    """
+        Cache of Reader.read results: in-memory LRU shared by the process and pickles on disk.
+        Key is made of read parameters and identities (path, mtime, size) of source files,
+        so a rewritten quote file never hits an old entry. Writer also invalidates entries explicitly.
+        Reader neither looks up nor stores results while any source file is missing
+    """
+    _memory = OrderedDict()
+    _lock = threading.Lock()
+
+    def __init__(self, enabled=True, directory='cache', memory_entries=8, disk_bytes=1024 ** 3):
+        """
+        :param enabled: if False nothing is stored and get always misses
+        :param directory: folder of pickles relative to the current directory
+        :param memory_entries: max number of results kept in memory
+        :param disk_bytes: max total size of pickles, the least recently used ones are removed
+        """
+        self.enabled = enabled
+        self.directory = directory
+        self.memory_entries = memory_entries
+        self.disk_bytes = disk_bytes
+
+    @staticmethod
+    def make_key(params, fnames):
+        """
+        :param params: dict of read parameters
+        :param fnames: list of source files
+        :return: str
+        """
+        identity = []
+        for fname in fnames:
+            try:
+                st = os.stat(fname)
+                identity.append((fname, st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                identity.append((fname, None, None))
+        payload = repr((sorted(params.items()), identity))
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def _path(self, key, ext='.pkl'):
+        return os.path.join(create_folder_if_not_exists(self.directory), key + ext)
+
+    def get(self, key):
+        """
+        :return: copy of cached DataFrame or None
+        """
+        if not self.enabled:
+            return None
+        with ReadCache._lock:
+            if key in ReadCache._memory:
+                ReadCache._memory.move_to_end(key)
+                return ReadCache._memory[key][1].copy()
+        fname = self._path(key)
+        if not os.path.isfile(fname):
+            return None
+        with open(fname, 'rb') as f:
+            fnames, df = pickle.load(f)
+        # mtime of pickle is the time of the last use
+        os.utime(fname)
+        self._remember(key, fnames, df)
+        return df.copy()
+
+    def put(self, key, df, fnames):
+        """
+        :param key: str from make_key
+        :param df: result of Reader.read
+        :param fnames: list of source files
+        """
+        if not self.enabled:
+            return
+        self._remember(key, fnames, df.copy())
+        fname = self._path(key)
+        with open(fname + '.tmp', 'wb') as f:
+            pickle.dump((list(fnames), df), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(fname + '.tmp', fname)
+        with open(self._path(key, ext='.src'), 'w') as f:
+            f.write('\n'.join(fnames))
+        self._evict_disk()
+
+    def _remember(self, key, fnames, df):
+        with ReadCache._lock:
+            ReadCache._memory[key] = (list(fnames), df)
+            ReadCache._memory.move_to_end(key)
+            while len(ReadCache._memory) > self.memory_entries:
+                ReadCache._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        entries = [(os.path.getmtime(fname), os.path.getsize(fname), fname)
+                   for fname in glob.glob(self._path('*'))]
+        total = sum(size for _, size, _ in entries)
+        for _, size, fname in sorted(entries):
+            if total <= self.disk_bytes:
+                break
+            self._remove(fname[:-len('.pkl')])
+            total -= size
+
+    @staticmethod
+    def _remove(prefix):
+        for ext in ('.pkl', '.src'):
+            if os.path.isfile(prefix + ext):
+                os.remove(prefix + ext)
+
+    def invalidate(self, pattern):
+        """
+            Remove entries built from files matching the glob pattern
+        :param pattern: like '/path/quotes/1_MMVB_3_SBER_*.csv'
+        :return: number of removed entries
+        """
+        # an entry can be both in memory and on disk, it is counted once
+        removed = set()
+        with ReadCache._lock:
+            for key, (fnames, _) in list(ReadCache._memory.items()):
+                if any(fnmatch.fnmatch(fname, pattern) for fname in fnames):
+                    del ReadCache._memory[key]
+                    removed.add(key)
+        for src in glob.glob(self._path('*', ext='.src')):
+            with open(src, 'r') as f:
+                fnames = f.read().split('\n')
+            if any(fnmatch.fnmatch(fname, pattern) for fname in fnames):
+                self._remove(src[:-len('.src')])
+                removed.add(os.path.basename(src)[:-len('.src')])
+        return len(removed)
@@ -1,11 +1,22 @@
-from pandas import read_csv
 from pandas import date_range
 from pandas import DataFrame
+from pandas import Timestamp
+from pandas import Timedelta
+from pandas import concat
+from pandas.tseries.frequencies import to_offset
 import os
-from writer import Writer
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scheduler import DownloadScheduler
 from quotesio import QuotesIO
 from utilites import normalize_data
 from utilites import compute_daily_returns
+from utilites import fill_missing_values
+from utilites import resample_bars
+from storage import iter_intraday
+from panel import Panel
+import kernels
+import metrics
 
 
 class Reader(QuotesIO):
@@ -15,34 +26,46 @@ class Reader(QuotesIO):
     In update mode metadata will be updated and the newest metadata file will be used
     to getting new quotes.
     If a date is specified, the metadata file like 'dd-mm-yyyy.csv'
-    and quote files like '*_dd-mm-yyyy.csv' will be used
+    and quote files like '*_dd-mm-yyyy.csv' will be used.
+    Intraday timeframes are read with DATE + TIME index and resampled to bars
     """
+    # pandas rules of timeframes, ticks have to be resampled to a bar explicitly
+    intraday_rules = {'1min': '1min', '5min': '5min', '10min': '10min', '15min': '15min', '30min': '30min', 'H': 'H'}
 
+    @metrics.staged('read')
     def read(self, reference: dict, dfrom='2016-01-01', dto=None, price='CLOSE', volume=False,
-             download_if_not_exists=True, normed=True, daily_returns=True):
-
-        df = self._make_initial_df(dfrom, dto)
-        for _, sec in self._find_securities():
-            fname = self._make_fname(sec,
-                                     self.tf_symbol,
-                                     self.quote_dir,
-                                     self._get_todate())
-
-            df = self.get_data_from_file_or_download_it(df,
-                                                        download_if_not_exists,
-                                                        fname,
-                                                        price,
-                                                        sec,
-                                                        volume)
-
-            df = self._dropnan(df, reference, sec)
-            df = self._mark_ref(df, reference, sec)
-
-        if normed:
-            df = self._normalize_data(df)
-        if daily_returns:
-            df = self._compute_daily_returns(df)
-        df = self._fill_missing_values(df)
+             download_if_not_exists=True, normed=True, daily_returns=True, bar=None, fill_missing=True):
+        """
+        :param reference: dict {field_name: value}, None to keep all dates without '_Ref' column
+        :param fill_missing: fill missing values forward and backward
+        :param bar: pandas rule like '5min' or 'H' to resample quotes to,
+                    by default intraday timeframes are kept as is and daily quotes are read by DATE only
+        """
+        bar, index, securities, fnames = self._prepare(dfrom, dto, bar)
+        params = {'reference': reference, 'dfrom': index[0], 'dto': index[-1], 'price': price, 'volume': volume,
+                  'normed': normed, 'daily_returns': daily_returns, 'bar': bar, 'fill_missing': fill_missing}
+
+        # a result without some files isn't cached, so missing files are downloaded or looked for next time
+        df = None
+        if all(os.path.isfile(fname) for fname in fnames):
+            df = self.read_cache.get(self.read_cache.make_key(params, fnames))
+        if df is not None:
+            self.logger.info("[%u] Result dataset is taken from cache" % os.getpid())
+        else:
+            frames = self._read_all(securities, fnames, download_if_not_exists, price, volume, bar, reference)
+            complete = all(frame is not None for frame in frames)
+            with metrics.timer('join_seconds'):
+                df = self._assemble(index, securities, frames, reference)
+
+            if normed:
+                df = self._normalize_data(df)
+            if daily_returns:
+                df = self._compute_daily_returns(df)
+            if fill_missing:
+                df = self._fill_missing_values(df)
+            if complete:
+                # files might have been downloaded, so the key is made again
+                self.read_cache.put(self.read_cache.make_key(params, fnames), df, fnames)
 
         self.logger.info("[%u] Result dataset has size %d x %d" % (os.getpid(), df.shape[0], df.shape[1]))
         self.logger.info("[%u] First row:" % os.getpid())
@@ -51,18 +74,156 @@ class Reader(QuotesIO):
         print(df.tail(10))
         return df
 
-    def _mark_ref(self, df, reference, sec):
+    @metrics.staged('read')
+    def read_panel(self, path, reference: dict, dfrom='2016-01-01', dto=None, price='CLOSE', volume=False,
+                   download_if_not_exists=True, normed=True, daily_returns=True, bar=None, fill_missing=True,
+                   dtype='float32'):
+        """
+            The same as read, but the result is a memory-mapped Panel instead of DataFrame.
+            Columns are filled security by security and transformed in place by blocks,
+            the reference column goes last, so the other columns are a contiguous view
+        :param path: path of panel files without extension
+        :param dtype: 'float32' or 'float64'
+        :return: Panel opened read only
+        """
+        bar, index, securities, fnames = self._prepare(dfrom, dto, bar)
+        frames = self._read_all(securities, fnames, download_if_not_exists, price, volume, bar, reference)
+        securities, frames = self._reference_last(securities, frames, reference)
+        with metrics.timer('join_seconds'):
+            index, columns = self._layout(index, securities, frames, reference)
+            panel = Panel.create(path, index, columns, dtype=dtype)
+            self._fill(panel.values, index, frames)
+        self._transform_inplace(panel.values, normed, daily_returns, fill_missing)
+        panel.flush()
+        del panel
+
+        panel = Panel.open(path)
+        self.logger.info("[%u] Panel %s has size %d x %d, %.1f MB" %
+                         (os.getpid(), path, panel.shape[0], panel.shape[1], panel.nbytes / 2 ** 20))
+        return panel
+
+    def _prepare(self, dfrom, dto, bar):
+        """
+        :return: (bar, initial date index, securities, quote files)
+        """
+        if bar is None:
+            bar = self.intraday_rules.get(self.tf_symbol)
+        if bar is None and self.tf_symbol == 'ticks':
+            raise ValueError("Ticks have to be resampled, bar is needed")
+
+        index = self._make_initial_df(dfrom, dto, bar).index
+        securities = [sec for _, sec in self._find_securities()]
+        fnames = [self._quote_fname(sec) for sec in securities]
+        return bar, index, securities, fnames
+
+    def _read_all(self, securities, fnames, download_if_not_exists, price, volume, bar=None, reference=None):
+        """
+            Read files of all securities in parallel. Missing files are scheduled for download at once,
+            the reference security first, existing files are read while they are being downloaded
+        :return: list of DataFrames in order of securities, None if there is no file
+        """
+        if download_if_not_exists:
+            missing = [sec for sec, fname in zip(securities, fnames) if not os.path.isfile(fname)]
+            if missing:
+                field, value = self._get_reference(reference) if reference else (None, None)
+                DownloadScheduler.get(self.mode).ensure(
+                    missing, priorities=[0 if field is not None and sec[field] == value else 1 for sec in missing])
+
+        def read_one(sec, fname):
+            return self.get_data_from_file_or_download_it(download_if_not_exists, fname, price, sec, volume, bar)
+
+        with ThreadPoolExecutor(max_workers=self.config['read']['workers']) as executor:
+            return list(executor.map(read_one, securities, fnames))
+
+    def _assemble(self, index, securities, frames, reference):
+        """
+            Align all securities on the index in one pass.
+            Dates where the reference security has no data are dropped before the panel is allocated,
+            price column of the reference security gets '_Ref' suffix
+        :param index: initial date index
+        :param securities: rows of metadata
+        :param frames: DataFrames of securities, frames are released while the panel is being filled
+        :param reference: dict {field_name: value} or None
+        :return: DataFrame
+        """
+        index, columns = self._layout(index, securities, frames, reference)
+        values = self._fill(np.empty((len(index), len(columns))), index, frames)
+        self.logger.info("[%u] %d columns have been joined" % (os.getpid(), len(columns)))
+        return DataFrame(values, index=index, columns=columns, copy=False)
+
+    def _layout(self, index, securities, frames, reference):
+        """
+            Dates and columns of the panel. If the reference security hasn't been found,
+            only dates where all securities have data are kept
+        :return: (index, columns)
+        """
+        reference_field_name, reference_value = self._get_reference(reference) if reference else (None, None)
+        drop_any_nan = False
+        columns = []
+        for sec, frame in zip(securities, frames):
+            is_ref = reference_field_name is not None and sec[reference_field_name] == reference_value
+            if is_ref and frame is None:
+                self.logger.warn("[%u] Reference security paper %s:%s hasn't been found"
+                                 % (os.getpid(), reference_field_name, reference_value))
+                drop_any_nan = True
+            elif is_ref:
+                index = index[frame[sec['emitent_code']].reindex(index).notna().values]
+            if frame is not None:
+                columns += [col + '_Ref' if is_ref and col == sec['emitent_code'] else col
+                            for col in frame.columns]
+        if drop_any_nan:
+            for frame in frames:
+                if frame is not None:
+                    index = index[frame.reindex(index).notna().all(axis=1).values]
+        return index, columns
+
+    @staticmethod
+    def _fill(values, index, frames):
+        """
+            Copy frames aligned on the index to columns of values, frames are released one by one
+        :return: values
+        """
+        pos = 0
+        for i, frame in enumerate(frames):
+            if frame is None:
+                continue
+            frames[i] = None
+            width = frame.shape[1]
+            values[:, pos:pos + width] = frame.reindex(index).values
+            pos += width
+        return values
+
+    def _reference_last(self, securities, frames, reference):
+        """
+        :return: (securities, frames) where the reference security is moved to the end
+        """
+        if not reference:
+            return securities, frames
         reference_field_name, reference_value = self._get_reference(reference)
-        if sec[reference_field_name] == reference_value:
-            df = df.rename(columns={sec['emitent_code']: sec['emitent_code'] + '_Ref'})
-        return df
+        order = sorted(range(len(securities)),
+                       key=lambda i: securities[i][reference_field_name] == reference_value)
+        return [securities[i] for i in order], [frames[i] for i in order]
+
+    @staticmethod
+    def _transform_inplace(values, normed, daily_returns, fill_missing, block_bytes=64 * 2 ** 20):
+        """
+            Normalize, compute returns and fill missing values of the panel in place by blocks of columns,
+            so temporary float64 arrays are limited by block_bytes
+        """
+        width = max(1, block_bytes // (8 * max(1, values.shape[0])))
+        for start in range(0, values.shape[1], width):
+            block = values[:, start:start + width]
+            if normed:
+                kernels.normalize(block, out=block, skipna=True)
+            if daily_returns:
+                kernels.simple_returns(block, out=block)
+            if fill_missing:
+                kernels.fill_missing(block, out=block)
 
     @staticmethod
     def _fill_missing_values(df_data):
-        """Fill missing values in data frame, in place."""
-        df_data.fillna(method='ffill', inplace=True)
-        df_data.fillna(method='bfill', inplace=True)
-        return df_data
+        """Forward fill and then backward fill for leading missing values."""
+        return fill_missing_values(df_data)
 
     @staticmethod
     def _compute_daily_returns(df):
@@ -71,28 +232,22 @@ class Reader(QuotesIO):
 
     @staticmethod
     def _normalize_data(df):
-        return normalize_data(df)
+        # securities listed after the first date are normalized by their first price
+        return normalize_data(df, skipna=True)
 
-    def get_data_from_file_or_download_it(self, df, download_if_not_exists, fname, price, sec, volume):
+    def get_data_from_file_or_download_it(self, download_if_not_exists, fname, price, sec, volume, bar=None):
+        """
+        :return: DataFrame of the security or None if there is no file
+        """
         if os.path.isfile(fname):
-            df = self._read_and_join_df(df, fname, price, sec, volume)
-        else:
-            self.logger.warn("[%u] %s doesn't exist" % (os.getpid(), fname))
-            if download_if_not_exists:
-                Writer(self.mode, emitent_id=[sec['emitent_id']]).save()
-                df = self._read_and_join_df(df, fname, price, sec, volume)
-        return df
-
-    def _dropnan(self, df, reference, sec):
-        reference_field_name, reference_value = self._get_reference(reference)
-        if sec[reference_field_name] == reference_value:
-            try:
-                df = df.dropna(subset=[sec['emitent_code']])
-            except KeyError:
-                self.logger.warn("[%u] Reference security paper %s:%s hasn't been found"
-                                 % (os.getpid(), reference_field_name, reference_value))
-                df = df.dropna()
-        return df
+            return self._read_file(fname, price, sec, volume, bar)
+        self.logger.warn("[%u] %s doesn't exist" % (os.getpid(), fname))
+        if download_if_not_exists:
+            # the download is shared with other readers of the security
+            DownloadScheduler.get(self.mode).ensure([sec])[sec['emitent_id']].result()
+            if os.path.isfile(fname):
+                return self._read_file(fname, price, sec, volume, bar)
+        return None
 
     @staticmethod
     def _get_reference(reference):
@@ -100,33 +255,53 @@ class Reader(QuotesIO):
         reference_value = str(reference[reference_field_name])
         return reference_field_name, reference_value
 
-    def _read_and_join_df(self, df, fname, price, sec, volume):
-        df_temp = self._read_file(fname, price, sec, volume)
-        df = df.join(df_temp)
-        return df
-
-    def _read_file(self, fname, price, sec, volume):
+    def _read_file(self, fname, price, sec, volume, bar=None):
         self.logger.info("[%u] Start reading the %s: "
                          % (os.getpid(), fname))
         col_for_rename = {price: sec['emitent_code']}
         if volume:
-            usecols = ['DATE', price, 'VOL']
+            columns = [price, 'VOL']
             col_for_rename['VOL'] = sec['emitent_code'] + '_V'
         else:
-            usecols = ['DATE', price]
-        df_temp = read_csv(fname,
-                           sep=';',
-                           index_col='DATE',
-                           parse_dates=True,
-                           usecols=usecols,
-                           na_values=['nan'])
+            columns = [price]
+        with metrics.timer('file_read_seconds', format=self.storage.ext):
+            if bar is None:
+                df_temp = self.storage.read(fname, columns=columns)
+            else:
+                df_temp = self._read_bars(fname, columns, bar)
+        metrics.count('file_reads_total', format=self.storage.ext)
+        metrics.count('file_read_rows_total', len(df_temp), format=self.storage.ext)
+        if self.metrics.enabled:
+            metrics.count('file_read_bytes_total', os.path.getsize(fname), format=self.storage.ext)
         df_temp = df_temp.rename(columns=col_for_rename)
         return df_temp
 
-    def _make_initial_df(self, dfrom, dto):
+    def _read_bars(self, fname, columns, bar):
+        """
+            Read quotes by chunks and resample every chunk,
+            bars split between chunks are merged by the second resampling
+        :return: DataFrame of bars
+        """
+        parts = [resample_bars(chunk, bar)
+                 for chunk in iter_intraday(self.storage,
+                                            fname,
+                                            columns,
+                                            chunksize=self.config['read']['chunksize'],
+                                            date_format=self.config['request']['date_format'],
+                                            time_format=self.config['request']['time_format'])]
+        if len(parts) == 1:
+            return parts[0]
+        return resample_bars(concat(parts), bar)
+
+    def _make_initial_df(self, dfrom, dto, bar=None):
         if dto is None:
             dto = self._get_todate()
             # dto.reverse()
             dto = '-'.join(dto)
-        dates = date_range(dfrom, dto)
+        if bar is None:
+            dates = date_range(dfrom, dto)
+        else:
+            # bars of the whole last day
+            end = Timestamp(dto) + Timedelta(days=1) - to_offset(bar)
+            dates = date_range(dfrom, end, freq=bar)
         return DataFrame(index=dates)
@@ -0,0 +1,210 @@
+import numpy as np
+from pandas import DataFrame
+from pandas import MultiIndex
+from kernels import as_float
+from kernels import simple_returns
+from utilites import lazy_import
+
+special = lazy_import('scipy.special')
+
+SUMMARY = ('cum_ret', 'avg_daily_ret', 'std_daily_ret', 'sharp_ratio', 'sortino_ratio',
+           'var_historical', 'cvar_historical', 'var_parametric', 'cvar_parametric',
+           'max_drawdown', 'max_drawdown_duration', 'beta')
+ROLLING = ('avg_daily_ret', 'std_daily_ret', 'sharp_ratio', 'sortino_ratio',
+           'var_historical', 'cvar_historical', 'var_parametric', 'cvar_parametric',
+           'max_drawdown', 'max_drawdown_duration', 'beta')
+
+
+class Risk:
+    """
+        Risk metrics of many portfolios at once. Values are a T x K matrix, one portfolio per column,
+        every metric is computed for all columns by the same array operation.
+        VaR and CVaR are positive losses of one period at the given confidence,
+        historical ones are taken from the ceil((1 - confidence) * n) worst returns,
+        parametric ones assume normal returns. Drawdown is negative, its duration is in periods.
+        Rolling moments, Sharpe, Sortino, beta and parametric VaR use running sums, so they are O(T)
+        whatever the window is; order statistics (historical VaR, CVaR and drawdown) have no running form,
+        they are computed on strided views of windows by blocks of max_bytes
+    """
+    def __init__(self, values, reference=None, risk_free_rate=0.0, confidence=0.95, samples_per_year=252):
+        """
+        :param values: 1d array T or 2d array T x K of portfolio values
+        :param reference: 1d array T of reference prices like '_Ref' column of Portfolio.price_ref, for beta
+        :param risk_free_rate: annual risk free rate
+        :param confidence: confidence level of VaR and CVaR
+        :param samples_per_year: daily=252, weekly=52, monthly=12
+        """
+        assert 0 < confidence < 1, "Confidence must be between 0 and 1"
+        values = as_float(values)
+        self.values = values.reshape(values.shape[0], -1)
+        self.returns = simple_returns(self.values)[1:]
+        self.ref_returns = None
+        if reference is not None and np.size(reference):
+            self.ref_returns = simple_returns(as_float(reference).reshape(-1))[1:]
+        self.confidence = confidence
+        self.samples_per_year = samples_per_year
+        self.period_risk_free_rate = (risk_free_rate + 1) ** (1 / samples_per_year) - 1
+        self.k = np.sqrt(samples_per_year)
+        self.z = special.ndtri(1 - confidence)
+
+    def _tail(self, n):
+        """
+        :return: number of worst returns in the tail of n returns
+        """
+        return max(1, int(np.ceil((1 - self.confidence) * n - 1e-9)))
+
+    def _parametric(self, mean, std):
+        """
+        :return: (VaR, CVaR) of normal returns
+        """
+        pdf = np.exp(-self.z ** 2 / 2) / np.sqrt(2 * np.pi)
+        return -(mean + self.z * std), -(mean - std * pdf / (1 - self.confidence))
+
+    def _ratios(self, mean, std, downside):
+        """
+        :param downside: mean of squared negative excess returns
+        :return: annualized (Sharp ratio, Sortino ratio)
+        """
+        excess = mean - self.period_risk_free_rate
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return excess / std * self.k, excess / np.sqrt(downside) * self.k
+
+    def _downside(self):
+        return np.minimum(self.returns - self.period_risk_free_rate, 0) ** 2
+
+    @staticmethod
+    def _drawdown(values, axis=0):
+        """
+            Maximum drawdown and the longest period below the running peak along axis
+        :return: (max drawdown, duration)
+        """
+        peak = np.maximum.accumulate(values, axis=axis)
+        drawdown = (values / peak - 1).min(axis=axis)
+        shape = [1] * values.ndim
+        shape[axis] = values.shape[axis]
+        steps = np.arange(values.shape[axis]).reshape(shape)
+        last_peak = np.maximum.accumulate(np.where(values >= peak, steps, 0), axis=axis)
+        return drawdown, (steps - last_peak).max(axis=axis)
+
+    def summary(self):
+        """
+            Metrics over the whole period
+        :return: 2d array K x len(SUMMARY)
+        """
+        n = len(self.returns)
+        mean = self.returns.mean(axis=0)
+        std = self.returns.std(axis=0, ddof=1)
+        sharp_ratio, sortino_ratio = self._ratios(mean, std, self._downside().mean(axis=0))
+        tail = self._tail(n)
+        worst = np.partition(self.returns, tail - 1, axis=0)[:tail]
+        var_parametric, cvar_parametric = self._parametric(mean, std)
+        drawdown, duration = self._drawdown(self.values)
+        beta = np.full(self.values.shape[1], np.nan)
+        if self.ref_returns is not None:
+            ref = self.ref_returns - self.ref_returns.mean()
+            beta = ref @ (self.returns - mean) / (ref @ ref)
+        return np.column_stack((self.values[-1] / self.values[0] - 1, mean, std, sharp_ratio, sortino_ratio,
+                                -worst.max(axis=0), -worst.mean(axis=0), var_parametric, cvar_parametric,
+                                drawdown, duration, beta))
+
+    @staticmethod
+    def _running(a, window):
+        """
+            Sums of a along the first axis over every window ending at rows window - 1, ..., T - 1
+        """
+        sums = np.cumsum(a, axis=0)
+        res = sums[window - 1:].copy()
+        res[1:] -= sums[:-window]
+        return res
+
+    @staticmethod
+    def _windows(a, window):
+        """
+            Read-only strided view (T - window + 1) x window x K of windows along the first axis
+        """
+        a = np.ascontiguousarray(a)
+        return np.lib.stride_tricks.as_strided(a, shape=(a.shape[0] - window + 1, window) + a.shape[1:],
+                                               strides=(a.strides[0],) + a.strides, writeable=False)
+
+    def rolling(self, window, max_bytes=256 * 2 ** 20):
+        """
+            Metrics over every window of returns, row t covers returns of rows t - window + 1 ... t
+            of values, so the first window rows are NaN
+        :param window: number of returns in a window
+        :param max_bytes: limit of temporary copies of windows
+        :return: dict {metric: 2d array T x K} for metrics of ROLLING
+        """
+        t, k = self.values.shape
+        assert 1 < window < t, "Window must be between 2 and number of returns"
+        res = {metric: np.full((t, k), np.nan) for metric in ROLLING}
+        rows = slice(window, t)
+
+        # returns are centered by column means, so differences of running sums don't lose precision
+        center = self.returns.mean(axis=0)
+        x = self.returns - center
+        sum_x = self._running(x, window)
+        mean = sum_x / window + center
+        std = np.sqrt(np.maximum(self._running(x * x, window) - sum_x ** 2 / window, 0) / (window - 1))
+        res['avg_daily_ret'][rows] = mean
+        res['std_daily_ret'][rows] = std
+        res['sharp_ratio'][rows], res['sortino_ratio'][rows] = \
+            self._ratios(mean, std, self._running(self._downside(), window) / window)
+        res['var_parametric'][rows], res['cvar_parametric'][rows] = self._parametric(mean, std)
+        if self.ref_returns is not None:
+            y = (self.ref_returns - self.ref_returns.mean())[:, None]
+            sum_y = self._running(y, window)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                res['beta'][rows] = (self._running(x * y, window) - sum_x * sum_y / window) / \
+                                    (self._running(y * y, window) - sum_y ** 2 / window)
+
+        tail = self._tail(window)
+        returns = self._windows(self.returns, window)
+        values = self._windows(self.values, window + 1)
+        chunk = max(1, int(max_bytes // (3 * 8 * (window + 1) * k)))
+        for start in range(0, len(returns), chunk):
+            block = slice(window + start, window + start + chunk)
+            worst = np.partition(returns[start:start + chunk], tail - 1, axis=1)[:, :tail]
+            res['var_historical'][block] = -worst.max(axis=1)
+            res['cvar_historical'][block] = -worst.mean(axis=1)
+            res['max_drawdown'][block], res['max_drawdown_duration'][block] = \
+                self._drawdown(values[start:start + chunk], axis=1)
+        return res
+
+
+def summary(values, reference=None, labels=None, **params):
+    """
+        Risk metrics of portfolios over the whole period
+    :param values: Series, DataFrame or array T x K of portfolio values
+    :param reference: reference prices for beta
+    :param labels: names of portfolios, columns of values DataFrame by default
+    :param params: risk_free_rate, confidence, samples_per_year of Risk
+    :return: DataFrame K x SUMMARY
+    """
+    labels = _labels(values, labels)
+    return DataFrame(Risk(values, reference, **params).summary(), index=labels, columns=list(SUMMARY))
+
+
+def rolling(values, window, reference=None, labels=None, index=None, max_bytes=256 * 2 ** 20, **params):
+    """
+        Rolling risk metrics of portfolios, see Risk.rolling
+    :param values: Series, DataFrame or array T x K of portfolio values
+    :param window: number of returns in a window
+    :param reference: reference prices for beta
+    :param labels: names of portfolios, columns of values DataFrame by default
+    :param index: dates, index of values by default
+    :param params: risk_free_rate, confidence, samples_per_year of Risk
+    :return: DataFrame T x (metric, portfolio)
+    """
+    labels = _labels(values, labels)
+    index = getattr(values, 'index', None) if index is None else index
+    res = Risk(values, reference, **params).rolling(window, max_bytes=max_bytes)
+    columns = MultiIndex.from_product([list(ROLLING), labels], names=['metric', 'portfolio'])
+    return DataFrame(np.hstack([res[metric] for metric in ROLLING]), index=index, columns=columns)
+
+
+def _labels(values, labels):
+    if labels is not None:
+        return list(labels)
+    if getattr(values, 'columns', None) is not None:
+        return list(values.columns)
+    return list(range(1 if np.ndim(values) == 1 else np.shape(values)[1]))
@@ -0,0 +1,105 @@
+import os
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future
+from writer import Writer
+
+
+class DownloadScheduler:
+    """
+        Process-wide queue of downloads of missing quote files, one scheduler per mode.
+        A security is downloaded once however many readers ask for it, securities with lower
+        priority value go first. Downloads run on 'download.workers' threads of config/quotesio.yaml
+        under the rate limit shared by all Writers of the process
+    """
+    _schedulers = {}
+    _lock = threading.Lock()
+
+    def __init__(self, mode='update'):
+        self.writer = Writer(mode)
+        self.workers = self.writer.config['download']['workers']
+        # heap of (priority, sequence number, emitent_id), a security can have several entries
+        self._queue = []
+        # {emitent_id: [sec, future, started]}
+        self._pending = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+
+    @classmethod
+    def get(cls, mode='update'):
+        """
+        :param mode: 'update' or date like 'dd-mm-yyyy' as in QuotesIO
+        :return: DownloadScheduler
+        """
+        with cls._lock:
+            if mode not in cls._schedulers:
+                cls._schedulers[mode] = cls(mode)
+            return cls._schedulers[mode]
+
+    @property
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    def ensure(self, securities, priorities=None):
+        """
+            Schedule downloads of securities without quote file
+        :param securities: list of metadata records
+        :param priorities: list of int, lower value goes first, 1 by default
+        :return: dict {emitent_id: Future}, result is None if the file exists or has been downloaded,
+                 otherwise error message
+        """
+        futures = {}
+        with self._cond:
+            for i, sec in enumerate(securities):
+                key = sec['emitent_id']
+                entry = self._pending.get(key)
+                if entry is None:
+                    future = Future()
+                    futures[key] = future
+                    if os.path.isfile(self.writer._quote_fname(sec)):
+                        future.set_result(None)
+                        continue
+                    self._pending[key] = [sec, future, False]
+                elif entry[2]:
+                    futures[key] = entry[1]
+                    continue
+                else:
+                    # already queued, a new entry with another priority is added, the first popped one wins
+                    futures[key] = entry[1]
+                heapq.heappush(self._queue, (1 if priorities is None else priorities[i], next(self._seq), key))
+            self._start_workers()
+            self._cond.notify_all()
+        return futures
+
+    def _start_workers(self):
+        while len(self._threads) < min(self.workers, len(self._pending)):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                _, _, key = heapq.heappop(self._queue)
+                entry = self._pending.get(key)
+                if entry is None or entry[2]:
+                    continue
+                entry[2] = True
+            sec, future = entry[0], entry[1]
+            try:
+                error = self.writer._download(sec)
+            except Exception as e:
+                self._finish(key)
+                future.set_exception(e)
+            else:
+                self._finish(key)
+                future.set_result(error)
+
+    def _finish(self, key):
+        with self._cond:
+            self._pending.pop(key, None)
@@ -0,0 +1,156 @@
+import os
+import json
+import asyncio
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from prototypes import Base
+from reader import Reader
+from scheduler import DownloadScheduler
+
+SELECTORS = ('market_id', 'market_name', 'emitent_id', 'emitent_code', 'emitent_name')
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class QuoteService(Base):
+    """
+        Long-running local HTTP service of price panels built on asyncio.
+        Reads run in a thread pool, metadata index and results of Reader.read stay in memory of the process
+        (see 'cache' section of config/quotesio.yaml). Concurrent identical requests share one read,
+        missing securities are downloaded through DownloadScheduler, so every security is downloaded once.
+
+        GET /panel?emitent_code=SBER,GAZP&reference=emitent_code:SBER&dfrom=2018-01-01&normed=1
+        GET /securities?market_id=1
+        GET /health
+    """
+    def __init__(self, mode='update'):
+        # not __name__, the module is also run as a script
+        Base.__init__(self, 'service')
+        self.mode = mode
+        self._executor = ThreadPoolExecutor(max_workers=self.config['workers'])
+        self._requests = {}
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        server = await asyncio.start_server(self._handle, self.config['host'], self.config['port'])
+        self.logger.info("[%u] Quote service is listening on %s:%s" %
+                         (os.getpid(), self.config['host'], self.config['port']))
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), self.config['timeout'])
+            # headers aren't used, they are read to the empty line
+            while (await asyncio.wait_for(reader.readline(), self.config['timeout'])) not in (b'\r\n', b'\n', b''):
+                pass
+            status, content_type, body = await self._dispatch(request_line.decode('latin-1').split())
+        except asyncio.TimeoutError:
+            writer.close()
+            return
+        except Exception as e:
+            self.logger.exception("[%u] Request failed" % os.getpid())
+            status, content_type, body = 500, 'text/plain', str(e).encode()
+        writer.write(('HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' %
+                      (status, STATUS[status], content_type, len(body))).encode('latin-1') + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _dispatch(self, request_line):
+        """
+        :param request_line: [method, target, version]
+        :return: (status, content type, body)
+        """
+        if len(request_line) != 3:
+            return 400, 'text/plain', b'Bad request line'
+        method, target, _ = request_line
+        if method != 'GET':
+            return 405, 'text/plain', b'Only GET is supported'
+        url = urlparse(target)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            if url.path == '/panel':
+                df = await self.panel(**self._parse_panel_params(params))
+                if params.get('format') == 'csv':
+                    return 200, 'text/csv', df.to_csv(sep=';').encode()
+                return 200, 'application/json', df.to_json(orient='split', date_format='iso').encode()
+            if url.path == '/securities':
+                securities = await self.securities(**self._parse_selectors(params))
+                return 200, 'application/json', json.dumps(securities, ensure_ascii=False).encode()
+            if url.path == '/health':
+                health = {'pid': os.getpid(),
+                          'requests': len(self._requests),
+                          'downloads': DownloadScheduler.get(self.mode).pending}
+                return 200, 'application/json', json.dumps(health).encode()
+        except (ValueError, KeyError) as e:
+            return 400, 'text/plain', str(e).encode()
+        return 404, 'text/plain', b'Unknown path'
+
+    @staticmethod
+    def _parse_selectors(params):
+        selectors = {selector: tuple(params[selector].split(',')) for selector in SELECTORS if selector in params}
+        if 'market_id' in selectors:
+            selectors['market_id'] = tuple(int(id_) for id_ in selectors['market_id'])
+        return selectors
+
+    def _parse_panel_params(self, params):
+        selectors = self._parse_selectors(params)
+        if not selectors:
+            raise ValueError("Securities aren't specified")
+        reference = None
+        if params.get('reference'):
+            field, _, value = params['reference'].partition(':')
+            reference = {field: value}
+        flag = {'1': True, 'true': True, '0': False, 'false': False}
+        return dict(selectors=selectors,
+                    reference=reference,
+                    dfrom=params.get('dfrom', '2016-01-01'),
+                    dto=params.get('dto'),
+                    price=params.get('price', 'CLOSE'),
+                    volume=flag[params.get('volume', '0').lower()],
+                    normed=flag[params.get('normed', '1').lower()],
+                    daily_returns=flag[params.get('daily_returns', '0').lower()],
+                    fill_missing=flag[params.get('fill_missing', '1').lower()],
+                    bar=params.get('bar'),
+                    download=flag[params.get('download', '1').lower()])
+
+    async def securities(self, **selectors):
+        """
+        :return: list of dicts of found securities
+        """
+        found = await self._run(lambda: [sec for _, sec in Reader(self.mode, **selectors)._find_securities()])
+        return [{field: sec[field] for field in SELECTORS} for sec in found]
+
+    async def panel(self, selectors, reference=None, dfrom='2016-01-01', dto=None, price='CLOSE', volume=False,
+                    normed=True, daily_returns=False, fill_missing=True, bar=None, download=True):
+        """
+            Panel of prices like Reader.read, identical concurrent requests are coalesced
+        :param selectors: dict {selector: tuple of values}
+        :return: DataFrame
+        """
+        params = dict(reference=reference, dfrom=dfrom, dto=dto, price=price, volume=volume, normed=normed,
+                      daily_returns=daily_returns, fill_missing=fill_missing, bar=bar)
+        key = repr((sorted(selectors.items()), sorted(params.items()), download))
+        future = self._requests.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._read(selectors, params, download))
+            self._requests[key] = future
+            future.add_done_callback(lambda _: self._requests.pop(key, None))
+        # a disconnected client doesn't cancel the read shared with others
+        return await asyncio.shield(future)
+
+    async def _read(self, selectors, params, download):
+        return await self._run(lambda: Reader(self.mode, **selectors).read(download_if_not_exists=download, **params))
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Local service of price panels')
+    parser.add_argument('--mode', default='update', help="'update' or date of metadata like dd-mm-yyyy")
+    QuoteService(parser.parse_args().mode).run()
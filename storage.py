@@ -0,0 +1,157 @@
+import os
+import glob
+import log
+from pandas import read_csv
+from pandas import read_parquet
+from pandas import to_datetime
+
+logger = log.logging.getLogger(__name__)
+
+PRICE_COLUMNS = ['OPEN', 'HIGH', 'LOW', 'CLOSE', 'LAST', 'VOL']
+
+# formats of DATE and TIME fields, keys are date_format and time_format of config/quotesio.yaml
+DATE_FORMATS = {1: '%Y%m%d', 2: '%y%m%d', 3: '%d%m%y', 4: '%d/%m/%y', 5: '%m/%d/%y'}
+TIME_FORMATS = {1: '%H%M%S', 2: '%H%M', 3: '%H:%M:%S', 4: '%H:%M'}
+# leading zeros of TIME are lost when it is stored as a number
+TIME_WIDTHS = {1: 6, 2: 4, 3: 8, 4: 5}
+
+
+def read_quotes_csv(fname, columns=None):
+    """
+        Read quotes in Finam csv format
+    :param fname: path or buffer
+    :param columns: list of columns to read, DATE is always read and used as index
+    :return: pandas DataFrame with DATE index and float OHLCV columns
+    """
+    usecols = None if columns is None else ['DATE'] + list(columns)
+    df = read_csv(fname,
+                  sep=';',
+                  index_col='DATE',
+                  parse_dates=True,
+                  usecols=usecols,
+                  na_values=['nan'])
+    typed = {col: 'float64' for col in df.columns if col in PRICE_COLUMNS}
+    return df.astype(typed)
+
+
+class CsvStorage:
+    """
+        ';'-separated text files as they are received from Finam
+    """
+    ext = '.csv'
+
+    def read(self, fname, columns=None):
+        return read_quotes_csv(fname, columns)
+
+    def write(self, fname, df):
+        df.to_csv(fname, sep=';', date_format='%Y%m%d')
+
+
+class ParquetStorage:
+    """
+        Binary columnar files, needs pyarrow or fastparquet
+    """
+    ext = '.parquet'
+
+    def read(self, fname, columns=None):
+        return read_parquet(fname, columns=None if columns is None else list(columns))
+
+    def write(self, fname, df):
+        df.to_parquet(fname)
+
+
+class FeatherStorage:
+    """
+        Binary columnar files, needs pyarrow.
+        Feather doesn't keep index, so DATE is stored as a column
+    """
+    ext = '.feather'
+
+    def read(self, fname, columns=None):
+        from pyarrow import feather
+        columns = None if columns is None else ['DATE'] + list(columns)
+        return feather.read_feather(fname, columns=columns).set_index('DATE')
+
+    def write(self, fname, df):
+        df.reset_index().to_feather(fname)
+
+
+def iter_intraday(storage, fname, columns, chunksize=None, date_format=1, time_format=1):
+    """
+        Read quotes with datetime index made of DATE and TIME.
+        Csv files are read by chunks, binary files are read at once with column projection
+    :param storage: storage instance
+    :param fname: quote file
+    :param columns: list of columns to read
+    :param chunksize: number of rows in chunk, None to read the whole file
+    :param date_format: see request.date_format of config/quotesio.yaml
+    :param time_format: see request.time_format of config/quotesio.yaml
+    :return: generator of DataFrames with float columns
+    """
+    typed = {col: 'float64' for col in columns if col in PRICE_COLUMNS}
+    width = TIME_WIDTHS[time_format]
+    if isinstance(storage, CsvStorage):
+        chunks = read_csv(fname,
+                          sep=';',
+                          usecols=['DATE', 'TIME'] + list(columns),
+                          dtype={'DATE': str, 'TIME': str},
+                          na_values=['nan'],
+                          chunksize=chunksize)
+        if chunksize is None:
+            chunks = [chunks]
+        for chunk in chunks:
+            chunk.index = to_datetime(chunk.pop('DATE') + chunk.pop('TIME').str.zfill(width),
+                                      format=DATE_FORMATS[date_format] + TIME_FORMATS[time_format])
+            yield chunk.astype(typed)
+    else:
+        # binary storages keep DATE as datetime index
+        df = storage.read(fname, columns=list(columns) + ['TIME'])
+        time = df.pop('TIME').astype(str).str.zfill(width)
+        df.index = to_datetime(df.index.strftime('%Y%m%d') + time.values,
+                               format='%Y%m%d' + TIME_FORMATS[time_format])
+        yield df.astype(typed)
+
+
+STORAGES = {
+    'csv': CsvStorage,
+    'parquet': ParquetStorage,
+    'feather': FeatherStorage
+}
+
+
+def get_storage(backend='csv'):
+    """
+    :param backend: 'csv', 'parquet' or 'feather'
+    :return: storage instance
+    """
+    try:
+        return STORAGES[backend]()
+    except KeyError:
+        raise ValueError("Unknown storage backend - %s, available: %s" % (backend, list(STORAGES)))
+
+
+def migrate(directory, backend, remove=True):
+    """
+        Convert all csv quote files of the directory to another storage format
+    :param directory: path to quote files
+    :param backend: target backend
+    :param remove: remove csv file after conversion
+    :return: list of new files
+    """
+    storage = get_storage(backend)
+    converted = []
+    for fname in sorted(glob.glob(os.path.join(directory, '*' + CsvStorage.ext))):
+        new_fname = fname[:-len(CsvStorage.ext)] + storage.ext
+        storage.write(new_fname, read_quotes_csv(fname))
+        logger.info("[%u] %s -> %s" % (os.getpid(), fname, new_fname))
+        if remove:
+            os.remove(fname)
+        converted.append(new_fname)
+    logger.info("[%u] %d files have been converted" % (os.getpid(), len(converted)))
+    return converted
+
+
+if __name__ == '__main__':
+    import sys
+    log.setup()
+    migrate(sys.argv[2] if len(sys.argv) > 2 else 'quotes', sys.argv[1])
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# modules of the project are top-level and resolve configs against the current directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from meanvar import MeanVariance
+from constraints import Constraints, ConstrainedOptimizer
+
+N = 10
+
+
+@pytest.fixture(scope='module')
+def model():
+    rng = np.random.RandomState(3)
+    prices = np.cumprod(1 + rng.normal(0.0008, 0.01, (500, N)) + rng.normal(0, 0.004, (500, 1)), axis=0)
+    return MeanVariance(prices, 0.05)
+
+
+CASES = {'max_position': dict(max_position=0.2),
+         'group_cap': dict(groups=[('market_id=1', np.arange(N) < 5, 0.4)]),
+         'turnover': dict(turnover=0.5, transaction_cost=0.002, previous=np.full(N, 0.1))}
+
+
+@pytest.mark.parametrize('solver', ['cvxpy', 'slsqp'])
+@pytest.mark.parametrize('case', ['max_position', 'group_cap'])
+def test_shorts_and_caps_keep_gross_exposure(model, solver, case):
+    if solver == 'cvxpy':
+        pytest.importorskip('cvxpy')
+    constraints = Constraints([(-1, 1)] * N, **CASES[case])
+    optimizer = ConstrainedOptimizer(model, constraints)
+    allocs = optimizer.solve(solver, strict=True)
+    assert np.abs(allocs).sum() == pytest.approx(1, abs=1e-4)
+    assert optimizer.errors == []
+
+
+def test_qp_matches_slsqp(model):
+    pytest.importorskip('cvxpy')
+    for kwargs in CASES.values():
+        constraints = Constraints([(-1, 1)] * N, **kwargs)
+        qp = ConstrainedOptimizer(model, constraints)
+        allocs = qp.solve('cvxpy', strict=True)
+        assert qp.solver == 'cvxpy'
+        slsqp = ConstrainedOptimizer(model, constraints)
+        reference = slsqp.solve('slsqp')
+        if not slsqp.errors:
+            assert model.sharp_ratio(allocs) == pytest.approx(model.sharp_ratio(reference), abs=1e-3)
+
+
+def test_infeasible_constraints_are_reported(model):
+    constraints = Constraints([(-1, 1)] * N, groups=[('market_id=1', np.ones(N, bool), 0.9)],
+                              turnover=0.3, previous=np.full(N, 0.1))
+    optimizer = ConstrainedOptimizer(model, constraints)
+    optimizer.solve('auto')
+    assert any('over cap' in error for error in optimizer.errors)
+    with pytest.raises(ValueError):
+        ConstrainedOptimizer(model, constraints).solve('auto', strict=True)
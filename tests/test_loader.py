@@ -0,0 +1,113 @@
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pandas as pd
+import pytest
+import benchmark
+from loader import Loader
+
+LISTED = 50
+
+
+class ChunkedServer:
+    """
+        Stand-in of Finam: market page and icharts.js are sent with chunked transfer encoding
+    """
+    def __init__(self, chunk_size=97):
+        self.payloads = {'/market.html': benchmark.make_market_page(),
+                         '/icharts.js': benchmark.make_icharts(LISTED)}
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server.requests.append(self.path)
+                body = server.payloads.get(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/javascript')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for start in range(0, len(body), chunk_size):
+                    chunk = body[start:start + chunk_size]
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                self.wfile.write(b'0\r\n\r\n')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def find_substring(text, start, stop):
+    """
+        Extraction of the original Loader: the whole text is searched
+    """
+    start_pos = text.find(start) + len(start)
+    return text[start_pos:][:text[start_pos:].find(stop)]
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    server = ChunkedServer()
+    args = argparse.Namespace(timeframe='D', workers=None, securities=2, years=1)
+    benchmark.prepare_workspace(str(tmp_path), server.url, args)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(Loader, 'path_to_metadata', str(tmp_path / 'metadata') + '/')
+    (tmp_path / 'metadata').mkdir()
+    yield server
+    server.stop()
+
+
+def expected_metadata(config):
+    """
+        Metadata frame made like the original Loader from the whole decoded icharts.js
+    """
+    templates = config['str_template']
+    text = benchmark.make_icharts(LISTED).decode('cp1251')
+    lists = {}
+    for type_info in ('emitent_ids', 'emitent_names', 'emitent_codes', 'emitent_markets'):
+        template = templates[type_info]
+        lists[type_info] = find_substring(text, template['start_from'], template['stop']).split(
+            template['split_symbol'])
+    return pd.DataFrame({'market_id': lists['emitent_markets'],
+                         'market_name': [benchmark.MARKET_NAME] * LISTED,
+                         'emitent_id': lists['emitent_ids'],
+                         'emitent_code': lists['emitent_codes'],
+                         'emitent_name': lists['emitent_names']},
+                        columns=list(Loader.columns))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 17, 4096, 10 ** 6])
+def test_extract_substrings_matches_whole_text_search(chunk_size):
+    body = benchmark.make_icharts(LISTED)
+    templates = {'ids': (b'var aEmitentIds = [', b']'),
+                 'names': (b'var aEmitentNames = [', b']'),
+                 'codes': (b'var aEmitentCodes = [', b']'),
+                 'markets': (b'var aEmitentMarkets = [', b']')}
+    chunks = (body[start:start + chunk_size] for start in range(0, len(body), chunk_size))
+    found = Loader._extract_substrings(chunks, templates)
+    assert found == {name: find_substring(body, start, stop) for name, (start, stop) in templates.items()}
+
+
+def test_parsed_and_reused_metadata_are_identical(workspace):
+    first = Loader()
+    parsed = first.available_data
+    pd.testing.assert_frame_equal(parsed, expected_metadata(first.config))
+
+    # the same content, parsing is skipped and metadata is read back from the csv file
+    second = Loader()
+    assert second._available_data is None
+    pd.testing.assert_frame_equal(second.available_data, parsed)
+    assert workspace.requests.count('/icharts.js') == 2
@@ -1,8 +1,35 @@
 import os
-import pandas as pd
+import sys
+import importlib.util
 from datetime import datetime
 import glob
-from pandas.core.indexing import IndexingError
+import threading
+import time
+import kernels
+
+
+def lazy_import(name):
+    """
+        Module which is really imported on the first access to its attribute
+    :param name: like 'scipy.optimize'
+    :return: module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    parent, _, child = name.rpartition('.')
+    if parent:
+        # like the import statement does, so 'import scipy.optimize' keeps working
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+pd = lazy_import('pandas')
 
 
 def get_path(subfolder=None):
@@ -14,12 +41,12 @@ def get_path(subfolder=None):
 # TODO create common config with HOME_DIR param and METADATA_DIR
 def create_folder_if_not_exists(dirname='metadata'):
     path = get_path(dirname)
-    if os.path.exists(path) is not True:
-        os.mkdir(path)
+    # download threads of DownloadScheduler can create it at the same time
+    os.makedirs(path, exist_ok=True)
     return path
 
 
-def save_file(payload: pd.DataFrame, path):
+def save_file(payload: 'pd.DataFrame', path):
     fname = datetime.today().strftime('%d-%m-%Y') + '.csv'
     payload.to_csv(path + fname, sep=';')
 
@@ -37,18 +64,85 @@ def rotate_files(path, pattern):
             os.remove(f)
 
 
-def normalize_data(df):
-    res = df.copy()
-    res = res / res.ix[0, :]
-    return res
+# how columns of quotes are aggregated into bars
+BAR_AGGREGATION = {'OPEN': 'first', 'HIGH': 'max', 'LOW': 'min', 'CLOSE': 'last', 'LAST': 'last', 'VOL': 'sum'}
+
+
+def resample_bars(df, rule):
+    """
+        Aggregate quotes with datetime index into bars, empty bars are dropped.
+        Bars of already aggregated chunks can be aggregated again with the same rule
+    :param df: DataFrame with columns like OPEN, HIGH, LOW, CLOSE, LAST, VOL
+    :param rule: pandas offset alias like '5min', 'H', 'D'
+    :return: DataFrame
+    """
+    how = {col: BAR_AGGREGATION.get(col, 'last') for col in df.columns}
+    bars = df.resample(rule).agg(how)
+    prices = [col for col in df.columns if col != 'VOL']
+    if prices:
+        return bars.dropna(how='all', subset=prices)
+    return bars[bars['VOL'] > 0]
+
+
+def _like(df, values):
+    """
+        Wrap array into Series or DataFrame with index and columns of df, values aren't copied
+    """
+    if isinstance(df, pd.Series):
+        return pd.Series(values, index=df.index, name=df.name, copy=False)
+    return pd.DataFrame(values, index=df.index, columns=df.columns, copy=False)
 
 
-def compute_daily_returns(df):
+def normalize_data(df, skipna=False):
+    """
+        Divide every column by its first value
+    :param df: DataFrame or Series of prices
+    :param skipna: divide by the first non-NaN value of a column instead of the first row
+    :return: DataFrame or Series
+    """
+    return _like(df, kernels.normalize(df.values, skipna=skipna))
+
+
+def compute_daily_returns(df, log=False):
     """Compute and return the daily return values."""
-    res = df.copy()
-    res[1:] = (df[1:] / df[:-1].values) - 1
-    try:
-        res.ix[0, :] = 0  # replace .ix
-    except IndexingError:
-        res.ix[0] = 0
-    return res
+    if log:
+        return _like(df, kernels.log_returns(df.values))
+    return _like(df, kernels.simple_returns(df.values))
+
+
+def fill_missing_values(df):
+    """
+        Forward fill and then backward fill for leading NaN
+    :param df: DataFrame or Series
+    :return: DataFrame or Series
+    """
+    return _like(df, kernels.fill_missing(df.values))
+
+
+class RateLimiter:
+    """
+        Thread safe limiter of requests per second for every host
+    """
+    def __init__(self, rates):
+        """
+        :param rates: dict {host: max requests per second}, key 'default' is used for unknown hosts
+        """
+        self.rates = dict(rates or {})
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def wait(self, host):
+        """
+            Block until a request to the host is allowed
+        :param host: str like 'export.finam.ru'
+        :return: None
+        """
+        rate = self.rates.get(host, self.rates.get('default'))
+        if not rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + 1.0 / rate
+        if slot > now:
+            time.sleep(slot - now)
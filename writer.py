@@ -1,30 +1,47 @@
 import os
+import time
+import threading
+import glob
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
 from utilites import create_folder_if_not_exists
 from utilites import rotate_files
-import requests
-import csv
+from utilites import RateLimiter
+from utilites import lazy_import
+from storage import CsvStorage
+from storage import read_quotes_csv
+from pandas import concat
+import metrics
 from quotesio import QuotesIO
 
+requests = lazy_import('requests')
+
 
 class Writer(QuotesIO):
     """
     The main goal of this class to get quotes and save it.
     Mode can be 'update' or date like 'dd-mm-yyyy'.
     In update mode metadata will be updated and the newest metadata file will be used.
-    If date is specified metadata file like 'dd-mm-yyyy.csv' will be used
+    If date is specified metadata file like 'dd-mm-yyyy.csv' will be used.
+    Securities are downloaded concurrently through one keep-alive session per process,
+    see 'download' section of config/quotesio.yaml
     """
+    _session = None
+    _rate_limiter = None
+    _lock = threading.Lock()
 
-    def _make_url(self, df_str):
-        domen = 'http://export.finam.ru/'
+    def _make_url(self, df_str, dfrom=datetime(1990, 1, 1)):
+        domen = self.config['url']['export']
         fname = 'payload.csv?'
         market = 'market=%s&' % df_str['market_id']
         em = 'em=%s&' % df_str['emitent_id']
         code = 'code=%s&' % df_str['emitent_code']
         apply = 'apply=0&'
-        df = 'df=1&'
-        mf = 'mf=0&'
-        yf = 'yf=1990&'
-        from_ = 'from=01.01.1990&'
+        df = 'df=%d&' % dfrom.day
+        mf = 'mf=%d&' % (dfrom.month - 1)
+        yf = 'yf=%d&' % dfrom.year
+        from_ = 'from=%s&' % dfrom.strftime('%d.%m.%Y')
         to_date = self._get_todate()
         dt = 'dt=%s&' % to_date[2]
         mt = 'mt=%s&' % (int(to_date[1].lstrip('0')) - 1)
@@ -74,46 +91,313 @@ class Writer(QuotesIO):
                + at)
         return url
 
-    def save(self):
+    @metrics.staged('save')
+    def save(self, securities=None):
+        """
+            Download quotes of securities concurrently
+        :param securities: list of metadata records, found securities are used by default
+        :return: dict {emitent_id: (emitent_code, None if success otherwise error message)}
+        """
+        create_folder_if_not_exists(dirname=self.quote_dir)
+        if securities is None:
+            securities = [sec for _, sec in self._find_securities()]
+        summary = {}
+        workers = self.config['download']['workers']
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self._download, sec): sec for sec in securities}
+            for future in as_completed(futures):
+                sec = futures[future]
+                try:
+                    error = future.result()
+                except Exception as e:
+                    # e.g. URL can't be made of the metadata row
+                    error = '%s: %s' % (type(e).__name__, e)
+                    self.logger.exception("[%u] Failed to download %s" % (os.getpid(), sec['emitent_code']))
+                summary[sec['emitent_id']] = (sec['emitent_code'], error)
+        self._report(summary)
+        return summary
+
+    def _download(self, sec):
+        """
+            Download quotes of one security, failed attempts are retried
+        :param sec: row of metadata
+        :return: None if success otherwise error message
+        """
+        self.logger.info("[%u] Start downloading the following: " % os.getpid())
+        self.logger.info("[%u] %s" % (os.getpid(), sec))
+        url = self._make_url(sec)
+        self.logger.info("[%u] URL %s" % (os.getpid(), url))
+        # DownloadScheduler calls it without save, so the directory may not exist yet on the first run
         create_folder_if_not_exists(dirname=self.quote_dir)
-        for _, sec in self._find_securities():
-            self.logger.info("[%u] Start downloading the following: " % os.getpid())
-            self.logger.info("[%u] %s" % (os.getpid(), sec))
-            url = self._make_url(sec)
-            self.logger.info("[%u] URL %s" % (os.getpid(), url))
 
-            self._get_write_and_rotate(sec, url)
+        retries = self.config['download']['retries']
+        error = None
+        for attempt in range(1, retries + 1):
+            try:
+                with metrics.timer('download_seconds'):
+                    self._get_write_and_rotate(sec, url)
+                metrics.count('downloads_total', result='ok')
+                return None
+            except (requests.RequestException, AssertionError, OSError) as e:
+                error = str(e)
+                metrics.count('download_errors_total')
+                self.logger.warning("[%u] Attempt %d/%d to download %s failed: %s" %
+                                    (os.getpid(), attempt, retries, sec['emitent_code'], error))
+                if attempt < retries:
+                    time.sleep(self.config['download']['retry_delay'] * attempt)
+            except Exception as e:
+                # e.g. unexpected body or stored file, retrying doesn't help, other securities go on
+                error = '%s: %s' % (type(e).__name__, e)
+                metrics.count('download_errors_total')
+                self.logger.exception("[%u] Failed to download %s" % (os.getpid(), sec['emitent_code']))
+                break
+        metrics.count('downloads_total', result='failed')
+        return error
+
+    def _report(self, summary):
+        failed = {id_: res for id_, res in summary.items() if res[1] is not None}
+        for id_, (code, _) in summary.items():
+            if id_ not in failed:
+                self.logger.info("[%u] %s (%s): OK" % (os.getpid(), code, id_))
+        for id_, (code, error) in failed.items():
+            self.logger.error("[%u] %s (%s): FAILED - %s" % (os.getpid(), code, id_, error))
+        self.logger.info("[%u] Downloaded %d of %d securities" %
+                         (os.getpid(), len(summary) - len(failed), len(summary)))
 
     def _get_write_and_rotate(self, sec, url):
-        r = self._get_response(url)
-        fname = self._make_fname(sec, self.tf_symbol, self.quote_dir, self._get_todate())
-        self._write_to_file(fname, r)
+        fname = self._make_fname(sec, self.tf_symbol, self.quote_dir, self._get_todate(), ext=self.storage.ext)
+        previous = self._find_previous_file(sec) if self._is_incremental() else None
+        if previous is None or not self._update_file(previous, fname, sec):
+            r = self._get_response(url)
+            self._save_response(fname, r)
         if self.mode == 'update':
             self._rotate_files(sec)
+        self.read_cache.invalidate(''.join(self._make_pattern(sec)))
+
+    def _is_incremental(self):
+        return (self.mode == 'update'
+                and self.config['download'].get('incremental', False)
+                and self.config['request']['date_format'] == 1)
+
+    def _find_previous_file(self, sec):
+        """
+            Find the newest quote file of the security
+        :param sec: row of metadata
+        :return: str or None if there is no file
+        """
+        path, pattern = self._make_pattern(sec)
+        list_of_files = glob.glob(path + pattern)
+        if not list_of_files:
+            return None
+        return max(list_of_files, key=os.path.getctime)
+
+    def _update_file(self, previous, fname, sec):
+        """
+            Download bars since the last stored date, append them to the previous file
+            and rename it to fname. Bars of the last stored date are downloaded again
+            because they might be incomplete
+        :param previous: the newest quote file of the security
+        :param fname: name of the updated file
+        :param sec: row of metadata
+        :return: False if previous file has no data and the full history is needed
+        """
+        if self.storage.ext != CsvStorage.ext:
+            return self._update_stored_file(previous, fname, sec)
+        last_date, offset = self._find_last_date(previous)
+        if last_date is None:
+            return False
+        self.logger.info("[%u] Update %s since %s" %
+                         (os.getpid(), previous, last_date.strftime('%Y-%m-%d')))
+        r = self._get_response(self._make_url(sec, dfrom=last_date))
+        self._append_to_file(previous, fname, offset, r)
+        if previous != fname:
+            os.remove(previous)
+        return True
+
+    def _update_stored_file(self, previous, fname, sec):
+        """
+            The same as _update_file for binary storage backends
+        """
+        df = self.storage.read(previous)
+        if df.empty:
+            return False
+        last_date = df.index.max().to_pydatetime()
+        self.logger.info("[%u] Update %s since %s" %
+                         (os.getpid(), previous, last_date.strftime('%Y-%m-%d')))
+        r = self._get_response(self._make_url(sec, dfrom=last_date))
+        new_df = self._parse_response(fname, r)
+        self.storage.write(fname, concat([df[df.index < last_date], new_df]))
+        if previous != fname:
+            os.remove(previous)
+        return True
+
+    def _save_response(self, fname, r):
+        if self.storage.ext == CsvStorage.ext:
+            self._write_to_file(fname, r)
+        else:
+            self.storage.write(fname, self._parse_response(fname, r))
+
+    def _parse_response(self, fname, r):
+        """
+            Turn the response into typed DataFrame through a temporary csv file
+        """
+        tmp_fname = fname + '.tmp'
+        self._write_to_file(tmp_fname, r)
+        try:
+            return read_quotes_csv(tmp_fname)
+        finally:
+            os.remove(tmp_fname)
+
+    @staticmethod
+    def _find_last_date(fname, block=65536):
+        """
+            Find the last stored date and the offset of its first row,
+            only the tail of the file is read
+        :param fname: quote file
+        :param block: initial size of the tail in bytes
+        :return: (datetime, int) or (None, None) if there is no data
+        """
+        with open(fname, 'rb') as f:
+            columns = f.readline().decode().strip().split(';')
+            if 'DATE' not in columns:
+                return None, None
+            idx = columns.index('DATE')
+            data_start = f.tell()
+            size = f.seek(0, os.SEEK_END)
+            while True:
+                start = max(data_start, size - block)
+                f.seek(start)
+                lines = f.read(size - start).splitlines(keepends=True)
+                offset = start
+                if start > data_start and lines:
+                    # the first line is partial
+                    offset += len(lines[0])
+                    lines = lines[1:]
+                dates = [line.split(b';')[idx] for line in lines if line.strip()]
+                if not dates:
+                    if start == data_start:
+                        return None, None
+                    block *= 2
+                    continue
+                pos = offset
+                for line in lines:
+                    if line.strip() and line.split(b';')[idx] == dates[-1]:
+                        break
+                    pos += len(line)
+                if pos > offset or start == data_start:
+                    return datetime.strptime(dates[-1].decode(), '%Y%m%d'), pos
+                block *= 2
+
+    @staticmethod
+    def _append_to_file(previous, fname, offset, r, chunk_size=65536):
+        """
+            Write rows of the previous file before offset and rows of the streamed response
+            to a temporary file and rename it to fname, header of the response is skipped.
+            The previous file is left intact if the download is interrupted
+        """
+        tmp_fname = fname + '.tmp'
+        try:
+            with r, open(previous, 'rb') as src, open(tmp_fname, 'wb') as f:
+                left = offset
+                while left > 0:
+                    chunk = src.read(min(chunk_size, left))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    left -= len(chunk)
+                body = Writer._iter_body(r)
+                next(body)
+                for chunk in body:
+                    f.write(chunk)
+            os.replace(tmp_fname, fname)
+        finally:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
 
     def _rotate_files(self, sec):
+        rotate_files(*self._make_pattern(sec))
+
+    def _make_pattern(self, sec):
+        """
+        :param sec: row of metadata
+        :return: (directory, glob pattern of quote files of the security for any date)
+        """
+        ext = self.storage.ext
         path = self._make_fname(sec, self.tf_symbol, self.quote_dir, self._get_todate(), mode='dir_only')
         pattern = self._make_fname(sec,
                                    self.tf_symbol,
                                    self.quote_dir,
                                    self._get_todate(),
-                                   mode='file_only')[:-14] + '*.csv'
-        rotate_files(path, pattern)
+                                   mode='file_only',
+                                   ext=ext)[:-(10 + len(ext))] + '*' + ext
+        return path, pattern
 
     @staticmethod
     def _write_to_file(fname, r):
-        with open(fname, 'w') as f:
-            writer = csv.writer(f)
-            reader = csv.reader(r.text.splitlines())
+        """
+            Stream the response to a temporary file and rename it to fname
+        """
+        tmp_fname = fname + '.tmp'
+        try:
+            with r, open(tmp_fname, 'wb') as f:
+                for chunk in Writer._iter_body(r):
+                    f.write(chunk)
+            os.replace(tmp_fname, fname)
+        finally:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+
+    @staticmethod
+    def _iter_body(r, chunk_size=65536):
+        """
+            Stream the response body, '<' and '>' are removed from the header line only
+        :return: generator of bytes, the first item is the header line
+        """
+        chunks = r.iter_content(chunk_size=chunk_size)
+        head = b''
+        for chunk in chunks:
+            head += chunk
+            if b'\n' in head:
+                break
+        size = len(head)
+        header, sep, rest = head.partition(b'\n')
+        yield header.replace(b'<', b'').replace(b'>', b'') + sep
+        if rest:
+            yield rest
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+        metrics.count('http_response_bytes_total', size, host=urlparse(r.url).hostname)
 
-            for i, row in enumerate(reader):
-                if i == 0:
-                    row = [word.replace('<', '').replace('>', '') for word in row]
-                writer.writerow(row)
+    def _get_session(self):
+        """
+            Shared keep-alive session and rate limiter, created once per process
+        :return: requests.Session
+        """
+        with Writer._lock:
+            if Writer._session is None:
+                workers = self.config['download']['workers']
+                adapter = requests.adapters.HTTPAdapter(pool_connections=workers,
+                                                        pool_maxsize=workers)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers.update(self.config['headers'])
+                Writer._rate_limiter = RateLimiter(self.config['download']['rate_limit'])
+                Writer._session = session
+        return Writer._session
 
     def _get_response(self, url):
-        r = requests.get(url,
-                         headers=self.config['headers'],
-                         allow_redirects=True)
+        session = self._get_session()
+        host = urlparse(url).hostname
+        Writer._rate_limiter.wait(host)
+        with metrics.timer('http_request_seconds', host=host):
+            r = session.get(url,
+                            allow_redirects=True,
+                            stream=True,
+                            timeout=self.config['download']['timeout'])
+        metrics.count('http_requests_total', host=host, status=r.status_code)
+        if r.status_code != 200:
+            r.close()
         assert r.status_code == 200, "Response error - %s" % r.status_code
         return r